@@ -1,36 +1,166 @@
 import streamlit as st
-import pandas as pd
-import firebase_admin
-from firebase_admin import credentials, firestore
 import io
-from openpyxl import load_workbook
 import os
 import json
+import bisect
+import contextvars
+import functools
+import importlib
+import multiprocessing
+import uuid
+import hashlib
+import tempfile
+import random
+import threading
+import time
+import unicodedata
+import zipfile
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+class _LazyModule:
+    # Chỉ import module nặng khi dùng tới lần đầu: trang đăng nhập HS không phải chờ pandas, firebase...
+    def __init__(self, name): self._name = name
+    def __getattr__(self, attr): return getattr(importlib.import_module(self._name), attr)
+
+pd = _LazyModule('pandas')
+gexc = _LazyModule('google.api_core.exceptions')
+fs_transforms = _LazyModule('google.cloud.firestore_v1.transforms')
 
 # --- 1. CẤU HÌNH & DANH SÁCH NĂM ---
 st.set_page_config(page_title="Xem điểm online", page_icon="🎓", layout="wide")
 
 YEAR_LIST = [f"{y}-{y+1}" for y in range(2025, 2030)]
 
-def init_firebase():
+@st.cache_resource
+def _memory_client():
+    from memstore import MemoryClient
+    return MemoryClient()
+
+def _firebase_key():
+    # ƯU TIÊN 1: Chạy trên Server Render (Lấy từ biến môi trường)
+    if "FIREBASE_JSON" in os.environ:
+        key_dict = json.loads(os.environ["FIREBASE_JSON"])
+        if "private_key" in key_dict:
+            key_dict["private_key"] = key_dict["private_key"].replace("\\n", "\n")
+    # ƯU TIÊN 2: Chạy trên máy tính cá nhân (Lấy từ file secrets)
+    else:
+        key_dict = dict(st.secrets["firebase"])
+        key_dict["private_key"] = key_dict["private_key"].replace("\\n", "\n")
+    return key_dict
+
+def _connect(key_dict):
+    import firebase_admin
+    from firebase_admin import credentials, firestore
     if not firebase_admin._apps:
-        try:
-            # ƯU TIÊN 1: Chạy trên Server Render (Lấy từ biến môi trường)
-            if "FIREBASE_JSON" in os.environ:
-                key_dict = json.loads(os.environ["FIREBASE_JSON"])
-                if "private_key" in key_dict:
-                    key_dict["private_key"] = key_dict["private_key"].replace("\\n", "\n")
-            # ƯU TIÊN 2: Chạy trên máy tính cá nhân (Lấy từ file secrets)
-            else:
-                key_dict = dict(st.secrets["firebase"])
-                key_dict["private_key"] = key_dict["private_key"].replace("\\n", "\n")
-                
-            cred = credentials.Certificate(key_dict)
-            firebase_admin.initialize_app(cred)
+        firebase_admin.initialize_app(credentials.Certificate(key_dict))
+    return firestore.client()
+
+@st.cache_resource
+def _firestore_future():
+    # Kết nối 1 lần cho cả tiến trình, chạy nền để giao diện hiện ra trong lúc đang import/kết nối
+    return ThreadPoolExecutor(max_workers=1).submit(_connect, _firebase_key())
+
+class LazyClient:
+    # Firestore client: chỉ chờ kết nối xong khi thực sự truy cập dữ liệu
+    def __init__(self, future): self._future = future
+    def __getattr__(self, name):
+        try: client = self._future.result()
         except Exception as e:
+            _firestore_future.clear()
             st.error(f"Lỗi kết nối Firebase: {e}")
             st.stop()
-    return firestore.client()
+        return getattr(client, name)
+
+def init_firebase():
+    # DIEM_BACKEND=memory: chạy với dữ liệu trong bộ nhớ (thử nghiệm/đo hiệu năng, không cần Firebase)
+    if os.environ.get("DIEM_BACKEND") == "memory": return _memory_client()
+    try: return LazyClient(_firestore_future())
+    except Exception as e:
+        st.error(f"Lỗi kết nối Firebase: {e}")
+        st.stop()
+
+# --- Đo đếm truy cập Firestore: lượt đọc/ghi/xóa/query theo lượt chạy, session, hàm + độ trễ ---
+LAT_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)  # ms
+_current_fn = contextvars.ContextVar('diem_fn', default='khác')
+
+@st.cache_resource
+def _metrics():
+    # Dùng chung cho cả tiến trình
+    return {'lock': threading.Lock(), 'fn': defaultdict(Counter), 'hist': defaultdict(Counter)}
+
+def tracked_fn(fn):
+    # Gán các lượt truy cập Firestore bên trong cho tên hàm này
+    @functools.wraps(fn)
+    def wrapper(*a, **k):
+        tok = _current_fn.set(fn.__name__)
+        try: return fn(*a, **k)
+        finally: _current_fn.reset(tok)
+    return wrapper
+
+class Meter:
+    # Bộ đếm của 1 lượt chạy script; cộng dồn luôn vào bộ đếm session và bộ đếm toàn tiến trình
+    def __init__(self, session):
+        self.run, self.session, self.lock = Counter(), session, threading.Lock()
+
+    def record(self, op, ms, **counts):
+        bucket = next((f"≤{b}ms" for b in LAT_BUCKETS if ms <= b), f">{LAT_BUCKETS[-1]}ms")
+        fn = _current_fn.get(); m = _metrics()
+        with self.lock: self.run.update(counts); self.session.update(counts)
+        with m['lock']: m['fn'][fn].update(counts); m['fn'][fn]['ms'] += ms; m['hist'][op][bucket] += 1
+
+def _unwrap(x): return x._obj if isinstance(x, Tracked) else x
+
+class Tracked:
+    # Bọc client/collection/query/document/batch của Firestore, kết quả trả về cũng được bọc tiếp
+    def __init__(self, obj, meter): self._obj, self._meter = obj, meter
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr): return attr
+        kind = type(self._obj).__name__
+        def call(*a, **k):
+            a = [[_unwrap(r) for r in x] if name == 'get_all' else _unwrap(x) for x in a]
+            if name == 'commit':
+                # Đếm trước khi commit vì WriteBatch xóa danh sách thao tác sau khi gửi
+                ops = list(getattr(self._obj, '_write_pbs', None) or getattr(self._obj, '_ops', None) or [])
+                n_del = sum(1 for op in ops if getattr(op, 'delete', None) or (isinstance(op, tuple) and op[1] == 'delete'))
+            t0 = time.perf_counter()
+            res = attr(*a, **k)
+            ms = lambda: (time.perf_counter() - t0) * 1000
+            if name in ('stream', 'get_all'): return self._stream(res, name, t0)
+            if name == 'get':
+                if 'Document' in kind: self._meter.record('get', ms(), reads=1)
+                elif 'Aggregation' in kind: self._meter.record('count', ms(), reads=1, queries=1)
+                else: self._meter.record('query', ms(), reads=max(1, len(res)), queries=1)
+                return res
+            if name == 'commit':
+                self._meter.record('commit', ms(), writes=len(ops) - n_del, deletes=n_del)
+                return res
+            if name in ('set', 'update', 'create') and 'Document' in kind: self._meter.record(name, ms(), writes=1)
+            elif name == 'delete' and 'Document' in kind: self._meter.record(name, ms(), deletes=1)
+            if name in ('collection', 'document', 'where', 'order_by', 'select', 'limit', 'start_after', 'batch', 'count'): return Tracked(res, self._meter)
+            return res
+        return call
+
+    def _stream(self, it, op, t0):
+        n = 0
+        try:
+            for x in it: n += 1; yield x
+        finally: self._meter.record(op, (time.perf_counter() - t0) * 1000, reads=max(1, n), queries=1 if op == 'stream' else 0)
+
+def start_metering():
+    if '_m_session' not in st.session_state: st.session_state._m_session = Counter(); st.session_state._m_sid = uuid.uuid4().hex[:8]
+    return Meter(st.session_state._m_session)
+
+def finish_metering(meter):
+    st.session_state._m_last = meter.run
+    path = os.environ.get("DIEM_METRICS_LOG")
+    if path and meter.run:
+        rec = {'ts': time.time(), 'session': st.session_state.get('_m_sid'), 'page': st.session_state.get('page'), **meter.run}
+        try:
+            with open(path, 'a', encoding='utf-8') as f: f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        except OSError: pass
 
 # --- 2. CSS GIAO DIỆN (DÀNH CHO TOÀN TRANG & ADMIN) ---
 st.markdown("""
@@ -88,33 +218,437 @@ def safe_str(val):
     if s.endswith('.0'): s = s[:-2]
     return s
 
+def safe_str_col(col):
+    # Bản vector hóa của safe_str cho cả 1 cột
+    raw = col.astype(object).where(col.notna(), "").astype(str)
+    out = raw.str.strip().str.replace(r"\.0$", "", regex=True)
+    return out.mask(raw.str.lower().isin(['nan', 'none', '']), "")
+
+# Vị trí các cột điểm tính từ cột "Mã học sinh" (theo mẫu file xuất từ hệ thống)
+OFF_NAME, OFF_TX, OFF_GK, OFF_CK, OFF_TB, OFF_CN = -2, range(1, 10), 16, 26, 27, 28
+SCORE_FIELDS = ['id', 'year', 'sem', 'cls', 'sub', 'tx', 'gk', 'ck', 'tb', 'cn']
+
+def parse_score_sheet(df, sem):
+    # Hàm thuần (không đụng Firestore): 1 sheet môn -> DataFrame cột id, name, tx, gk, ck, tb, cn
+    empty = pd.DataFrame(columns=['id', 'name', 'tx', 'gk', 'ck', 'tb', 'cn'])
+    if df.empty: return empty
+    hit = df.astype(str).apply(lambda c: c.str.contains("Mã học sinh", case=False, regex=False, na=False)).any(axis=1).to_numpy()
+    if not hit.any(): return empty
+    h_idx = int(hit.argmax())
+    header = df.iloc[h_idx].tolist()
+    idx_ma = next((i for i,c in enumerate(header) if "Mã học sinh" in str(c)), -1)
+    if idx_ma == -1: return empty
+    body = df.iloc[h_idx+1:]; n = body.shape[1]
+    blank = pd.Series("", index=body.index)
+    def col(j): return safe_str_col(body.iloc[:, j]) if -n <= j < n else blank
+
+    ids = col(idx_ma)
+    keep = ids.str.len() > 3
+    j_name = idx_ma + OFF_NAME
+    tx = blank
+    for o in OFF_TX:
+        c = col(idx_ma+o); tx = tx + c.where(c == "", c + "  ")
+    out = pd.DataFrame({
+        'id': ids, 'name': col(j_name).astype(object) if -n <= j_name < n else None,
+        'tx': tx.str.rstrip(" "), 'gk': col(idx_ma+OFF_GK), 'ck': col(idx_ma+OFF_CK), 'tb': col(idx_ma+OFF_TB),
+        'cn': col(idx_ma+OFF_CN) if sem == 'HK2' else blank,
+    })
+    return out[keep.to_numpy()].reset_index(drop=True)
+
+def sub_priority(sub):
+    # Thứ tự môn trên phiếu điểm: Toán, Văn, Anh, các môn tính điểm, rồi các môn đánh giá
+    s = str(sub).lower()
+    if 'toán' in s: return 0
+    if 'văn' in s or 'ngữ văn' in s: return 1
+    if 'anh' in s or 'ngoại ngữ' in s: return 2
+    
+    eval_subs = ['thể chất', 'gdtc', 'quốc phòng', 'gdqp', 'trải nghiệm', 'hđtn', 'địa phương', 'nghệ thuật', 'âm nhạc', 'mỹ thuật']
+    if any(x in s for x in eval_subs): return 20 
+    return 10 
+
+# reports/{ma}_{year}_{sem}: phiếu điểm 1 HS/1 kỳ = subs ({môn: dòng điểm}) + summary (TK kỳ) + cn (TK cả năm, nằm ở kỳ HK2)
+# subs là map theo môn và được ghi bằng set(merge=True): mỗi lần nạp chỉ thay đúng các môn có trong file đó
+REPORT_ROW_FIELDS = ['sub', 'tx', 'gk', 'ck', 'tb', 'cn']
+REPORT_FIELD = {
+    ('scores', 'HK1'): ('HK1', 'subs'), ('scores', 'HK2'): ('HK2', 'subs'),
+    ('summary', 'HK1'): ('HK1', 'summary'), ('summary', 'HK2'): ('HK2', 'summary'), ('summary', 'CN'): ('HK2', 'cn'),
+}
+REPORT_PARTS = {'HK1': ('subs', 'summary'), 'HK2': ('subs', 'summary', 'cn')}  # phiếu luôn có đủ các phần này ({} = chưa có dữ liệu)
+TK_FIELDS = ['ht', 'rl', 'v', 'dh', 'kq']
+
+# --- Cache file upload: LRU theo SHA-256 nội dung, nhớ luôn parser đã đọc thành công ---
+# Giới hạn theo dung lượng ước tính (máy 512 MB), không theo số mục: 1 workbook HTML lớn có thể chiếm hàng chục MB
+UPLOAD_CACHE_BYTES = 64 * 1024 * 1024
+
+@st.cache_resource
+def _upload_cache():
+    return {'lru': OrderedDict(), 'bytes': 0, 'parser': {}, 'lock': threading.Lock()}
+
+def approx_size(val):
+    # Dung lượng ước tính (byte) của giá trị đưa vào cache: DataFrame, bytes/str, dict/list/tuple lồng nhau
+    if isinstance(val, (bytes, bytearray, str)): return len(val)
+    if isinstance(val, pd.DataFrame): return int(val.memory_usage(index=True, deep=True).sum())
+    if isinstance(val, dict): return sum(approx_size(k) + approx_size(v) for k, v in val.items())
+    if isinstance(val, (list, tuple, set)): return sum(approx_size(v) for v in val)
+    return 64
+
+def cache_get(key):
+    c = _upload_cache()
+    with c['lock']:
+        if key not in c['lru']: return None
+        c['lru'].move_to_end(key); return c['lru'][key][0]
+
+def cache_put(key, val):
+    size = approx_size(val)
+    if size > UPLOAD_CACHE_BYTES: return
+    c = _upload_cache()
+    with c['lock']:
+        if key in c['lru']: c['bytes'] -= c['lru'].pop(key)[1]
+        c['lru'][key] = (val, size); c['bytes'] += size
+        while c['bytes'] > UPLOAD_CACHE_BYTES: c['bytes'] -= c['lru'].popitem(last=False)[1][1]
+
+def cache_clear():
+    c = _upload_cache()
+    with c['lock']: c['lru'].clear(); c['bytes'] = 0
+
+def file_bytes(file):
+    if hasattr(file, 'getvalue'): return file.getvalue()
+    file.seek(0); return file.read()
+
+def file_hash(file): return hashlib.sha256(file_bytes(file)).hexdigest()
+
+def _read_as(raw, parser):
+    bio = io.BytesIO(raw)
+    if parser == 'xlsx': return pd.read_excel(bio, sheet_name=None, engine='openpyxl')
+    if parser == 'xls': return pd.read_excel(bio, sheet_name=None, engine='xlrd')
+    if parser == 'html': return {f"Sheet {i+1}": df for i, df in enumerate(pd.read_html(bio))}
+    return {'Sheet 1': pd.read_csv(bio)}
+
+def read_upload(file, parsers=('xlsx', 'xls', 'html')):
+    # {tên sheet: DataFrame} hoặc None. Kết quả dùng chung qua cache -> không sửa trực tiếp các DataFrame trả về
+    # Khóa gồm cả tập parser: cùng file đọc qua load_table_robust (có CSV) và load_excel_robust có thể cho kết quả khác nhau
+    raw = file_bytes(file); h = hashlib.sha256(raw).hexdigest(); key = ('wb', h, tuple(parsers))
+    data = cache_get(key)
+    if data is not None: return data
+    c = _upload_cache()
+    known = c['parser'].get(h)
+    if known in parsers: order = [known] + [p for p in parsers if p != known]
+    else:
+        # Đoán theo chữ ký file: PK = xlsx (zip), D0CF11E0 = xls (OLE); còn lại thường là HTML/CSV đổi đuôi .xls
+        sniff = 'xlsx' if raw[:4] == b'PK\x03\x04' else 'xls' if raw[:4] == b'\xd0\xcf\x11\xe0' else None
+        if sniff: order = sorted(parsers, key=lambda p: p != sniff)
+        else: order = sorted(parsers, key=lambda p: p in ('xlsx', 'xls'))
+    for parser in order:
+        try: data = _read_as(raw, parser)
+        except Exception: continue
+        with c['lock']:
+            if len(c['parser']) > 1000: c['parser'].clear()
+            c['parser'][h] = parser
+        cache_put(key, data)
+        return data
+    return None
+
 def load_excel_robust(file):
-    try: return pd.read_excel(file, sheet_name=None)
-    except:
-        try: file.seek(0); dfs = pd.read_html(file); return {f"Sheet {i+1}": df for i, df in enumerate(dfs)}
-        except: return None
+    return read_upload(file, ('xlsx', 'xls', 'html'))
+
+def load_table_robust(file):
+    # Sheet đầu tiên của file Excel/CSV (bản sao, được phép sửa)
+    data = read_upload(file, ('xlsx', 'xls', 'csv'))
+    if not data: raise ValueError("Không đọc được file")
+    return next(iter(data.values())).copy()
+
+SETTINGS_TTL = 300  # giây
+
+@st.cache_resource
+def _settings_cache():
+    # Dùng chung cho cả tiến trình (mọi session, mọi lần rerun)
+    return {'data': None, 'ts': 0.0, 'lock': threading.Lock()}
+
+def get_settings(db):
+    c = _settings_cache()
+    with c['lock']:
+        if c['data'] is None or time.time() - c['ts'] > SETTINGS_TTL:
+            try:
+                doc = db.collection('system_config').document('settings').get()
+                c['data'] = doc.to_dict() if doc.exists else {}; c['ts'] = time.time()
+            except: return c['data'] or {}
+        return c['data']
+
+def set_settings(db, values):
+    # Ghi xuống Firestore rồi cập nhật luôn cache (write-through), không cần đọc lại
+    db.collection('system_config').document('settings').set(values, merge=True)
+    c = _settings_cache()
+    with c['lock']:
+        if c['data'] is not None: c['data'] = {**c['data'], **values}
+
+def peek_settings():
+    # Settings đang có trong cache (None nếu chưa đọc lần nào) - không chạm Firestore, không chờ kết nối
+    return _settings_cache()['data']
 
 def get_current_year_config(db):
-    try:
-        doc = db.collection('system_config').document('settings').get()
-        if doc.exists: return doc.to_dict().get('default_year', '2024-2025')
-    except: pass
-    return '2024-2025'
+    return get_settings(db).get('default_year', '2024-2025')
 
 def set_current_year_config(db, year):
-    db.collection('system_config').document('settings').set({'default_year': year}, merge=True)
+    set_settings(db, {'default_year': year})
 
 def get_activation_fee(db):
-    try:
-        doc = db.collection('system_config').document('settings').get()
-        if doc.exists: return doc.to_dict().get('activation_fee', 15000)
-    except: pass
-    return 15000
+    return get_settings(db).get('activation_fee', 15000)
 
 def set_activation_fee(db, fee):
-    db.collection('system_config').document('settings').set({'activation_fee': fee}, merge=True)
+    set_settings(db, {'activation_fee': fee})
+
+# --- Bản sao trong bộ nhớ của năm học mặc định (bật bằng DIEM_MIRROR=1) ---
+# Listener on_snapshot giữ dữ liệu luôn mới; màn hình HS tra cứu năm mặc định không tốn lượt đọc Firestore.
+MIRROR_COLLECTIONS = ('students', 'reports', 'scores', 'summary')
+
+class YearMirror:
+    def __init__(self, db, year):
+        self.year, self.lock = year, threading.Lock()
+        self.docs = {c: {} for c in MIRROR_COLLECTIONS}
+        self.by_key = {c: defaultdict(set) for c in MIRROR_COLLECTIONS}  # (mã HS, kỳ) -> doc id
+        self.loaded = {c: threading.Event() for c in MIRROR_COLLECTIONS}
+        self.watches = [db.collection(c).where('year', '==', year).on_snapshot(functools.partial(self._on_snapshot, c)) for c in MIRROR_COLLECTIONS]
+
+    def _on_snapshot(self, coll, docs, changes, read_time):
+        with self.lock:
+            for ch in changes:
+                d = ch.document; old = self.docs[coll].pop(d.id, None)
+                if old is not None: self.by_key[coll][(old.get('id'), old.get('sem'))].discard(d.id)
+                if ch.type.name != 'REMOVED':
+                    data = d.to_dict(); self.docs[coll][d.id] = data
+                    self.by_key[coll][(data.get('id'), data.get('sem'))].add(d.id)
+        self.loaded[coll].set()
+
+    def ready(self): return all(e.is_set() for e in self.loaded.values())
+
+    def get(self, coll, doc_id):
+        with self.lock: return self.docs[coll].get(doc_id)
+
+    def find(self, coll, mid, sem):
+        with self.lock: return [self.docs[coll][k] for k in self.by_key[coll].get((mid, sem), ())]
+
+    def close(self):
+        for w in self.watches:
+            try: w.unsubscribe()
+            except Exception: pass
+
+class MirrorDoc:
+    # Giả lập DocumentSnapshot cho dữ liệu không đọc từ Firestore (bản sao / bộ lọc mã)
+    def __init__(self, data): self._data, self.exists = data, data is not None
+    def to_dict(self): return dict(self._data) if self._data is not None else None
+
+@st.cache_resource
+def _mirror_holder():
+    return {'mirror': None, 'lock': threading.Lock()}
+
+def mirror_for(db, year):
+    # Bản sao đã tải xong của đúng năm cần xem, hoặc None (-> đọc thẳng Firestore)
+    if os.environ.get("DIEM_MIRROR") != "1": return None
+    h = _mirror_holder(); default_year = get_current_year_config(db)
+    with h['lock']:
+        m = h['mirror']
+        if m is None or m.year != default_year:
+            if m is not None: m.close()
+            # Không dựng được bản sao (listener lỗi...) -> đọc thẳng Firestore, lượt sau thử lại
+            try: m = h['mirror'] = YearMirror(_unwrap(db), default_year)
+            except Exception: h['mirror'] = None; return None
+    return m if m.year == year and m.ready() else None
 
-def delete_data_year(db, collection, year, cls, sem=None):
+# --- Chặn tra cứu mã không tồn tại + giới hạn tốc độ tra cứu ---
+IDS_TTL = 3600  # giây; ngoài ra danh sách được dựng lại ngay khi ids_ver_<năm> trong settings đổi
+
+@st.cache_resource
+def _id_filters():
+    return {'years': {}, 'lock': threading.Lock()}
+
+def students_changed(db, year):
+    # Gọi sau khi thêm/xóa tài khoản HS: đổi phiên bản để mọi tiến trình dựng lại danh sách mã
+    set_settings(db, {f"ids_ver_{year}": uuid.uuid4().hex[:8]})
+    f = _id_filters()
+    with f['lock']: f['years'].pop(year, None)
+
+def data_changed(db, year, cls):
+    # Gọi sau khi nạp/xóa điểm hoặc tổng kết: đổi "thế hệ dữ liệu" của lớp -> kết quả HS đã lưu trong các phiên hết hiệu lực
+    classes = [f"Lớp {i}" for i in range(6, 13)] if cls == "Tất cả" else [cls]
+    token = uuid.uuid4().hex[:8]
+    set_settings(db, {f"gen_{year}_{c}": token for c in classes})
+
+def student_ids(db, year):
+    # Danh sách mã HS đã sắp xếp của 1 năm (quét chỉ lấy khóa), dùng chung cho cả tiến trình
+    f = _id_filters(); ver = get_settings(db).get(f"ids_ver_{year}")
+    with f['lock']:
+        e = f['years'].get(year)
+        if e and e['ver'] == ver and time.time() - e['ts'] < IDS_TTL: return e['ids']
+    ids = sorted(d.id.rsplit('_', 1)[0] for d in db.collection('students').where('year', '==', year).select(KEYS_ONLY).stream())
+    with f['lock']: f['years'][year] = {'ids': ids, 'ver': ver, 'ts': time.time()}
+    return ids
+
+def maybe_student(db, mid, year):
+    # False = chắc chắn không có mã này -> không cần đọc Firestore. Lỗi khi dựng danh sách thì cho qua.
+    try: ids = student_ids(db, year)
+    except Exception: return True
+    i = bisect.bisect_left(ids, mid)
+    return i < len(ids) and ids[i] == mid
+
+# (số lượt tối đa dồn được, số lượt hồi lại mỗi giây). Cả trường sau 1 NAT Wi-Fi / mạng di động (CGNAT) dùng chung 1 IP
+# -> giới hạn theo IP để rộng, chỉ chặn 1 máy gửi dồn dập; chặn dò mã là việc của bucket theo session + bộ lọc mã.
+# Đổi giới hạn IP: DIEM_LOOKUP_IP_LIMIT="600,10" ("0" = không giới hạn theo IP)
+LOOKUP_LIMITS = {'session': (10, 0.2), 'ip': (600, 10)}
+
+def ip_limit():
+    v = os.environ.get("DIEM_LOOKUP_IP_LIMIT", "").strip()
+    if not v: return LOOKUP_LIMITS['ip']
+    try: nums = [float(x) for x in v.split(',')]
+    except ValueError: return LOOKUP_LIMITS['ip']
+    if nums[0] <= 0: return None
+    return (nums[0], nums[1]) if len(nums) > 1 else (nums[0], LOOKUP_LIMITS['ip'][1])
+
+@st.cache_resource
+def _ip_buckets():
+    return {'buckets': {}, 'lock': threading.Lock()}
+
+def _take_token(bucket, cap, rate, now):
+    bucket['tokens'] = min(cap, bucket['tokens'] + (now - bucket['ts']) * rate); bucket['ts'] = now
+    if bucket['tokens'] < 1: return False
+    bucket['tokens'] -= 1; return True
+
+def client_ip():
+    # Chỉ tin địa chỉ do proxy của host (Render) nối vào CUỐI X-Forwarded-For; các mục phía trước do client tự đặt được.
+    # Không có X-Forwarded-For (chạy trực tiếp) -> None: chỉ giới hạn theo session, không gộp mọi người vào 1 bucket.
+    try: return (st.context.headers.get('X-Forwarded-For') or '').split(',')[-1].strip() or None
+    except Exception: return None
+
+def allow_lookup():
+    # Token bucket theo session và theo IP
+    now = time.time()
+    cap, rate = LOOKUP_LIMITS['session']
+    b = st.session_state.setdefault('_lookup_bucket', {'tokens': cap, 'ts': now})
+    if not _take_token(b, cap, rate, now): return False
+    ip, limit = client_ip(), ip_limit()
+    if not ip or not limit: return True
+    (cap, rate), g = limit, _ip_buckets()
+    with g['lock']:
+        if len(g['buckets']) > 10000:
+            g['buckets'] = {k: v for k, v in g['buckets'].items() if now - v['ts'] < 600}
+        return _take_token(g['buckets'].setdefault(ip, {'tokens': cap, 'ts': now}), cap, rate, now)
+
+def fetch_docs(db, collection, doc_ids, fields, chunk=300):
+    # Đọc nhiều document 1 lượt (get_all), chỉ lấy các field cần -> {doc_id: dict} cho doc đã tồn tại
+    found = {}
+    for i in range(0, len(doc_ids), chunk):
+        refs = [db.collection(collection).document(d) for d in doc_ids[i:i+chunk]]
+        for snap in db.get_all(refs, field_paths=fields):
+            if snap.exists: found[snap.id] = snap.to_dict() or {}
+    return found
+
+def record_fp(rec):
+    # Dấu vân tay nội dung bản ghi: tải lại file cũ -> so khớp fp để bỏ qua bản ghi không đổi
+    return hashlib.sha1(json.dumps(rec, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()[:16]
+
+# Lỗi tạm thời của Firestore (tranh chấp, vượt quota, timeout...) -> thử lại có backoff
+def retryable_errors():
+    return (gexc.Aborted, gexc.ResourceExhausted, gexc.ServiceUnavailable, gexc.DeadlineExceeded, gexc.InternalServerError)
+
+# Chỉ 2 lỗi này chắc chắn batch CHƯA được ghi; timeout / mất kết nối / lỗi server thì batch có thể đã ghi rồi
+# -> thao tác không idempotent (Increment) chỉ được thử lại với các lỗi này
+def unapplied_errors():
+    return (gexc.Aborted, gexc.ResourceExhausted)
+
+class ParallelWriter:
+    # Gom thao tác ghi thành batch (<=400) và commit song song trên 1 thread pool giới hạn
+    def __init__(self, db, batch_size=400, workers=8, retries=5):
+        self.db, self.batch_size, self.retries = db, batch_size, retries
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.Semaphore(workers * 2)  # giới hạn số batch đang chờ trong bộ nhớ
+        self.lock = threading.Lock()
+        self.ops, self.once_ops, self.futures = [], [], []  # once_ops: thao tác không idempotent, đi batch riêng
+        self.written, self.errors = 0, []  # errors: [(đường dẫn doc, lỗi)]
+
+    # idempotent=False (VD set có Increment): ghi 2 lần cho kết quả khác -> không thử lại khi không rõ batch đã ghi chưa
+    def set(self, ref, data, merge=False, idempotent=True): self._add(('set', ref, data, merge), idempotent)
+    def update(self, ref, data): self._add(('update', ref, data, False))
+    def delete(self, ref): self._add(('delete', ref, None, False))
+
+    def _add(self, op, idempotent=True):
+        ops = self.ops if idempotent else self.once_ops
+        ops.append(op)
+        if len(ops) >= self.batch_size: self.flush()
+
+    def flush(self):
+        for attr, retry in (('ops', retryable_errors), ('once_ops', unapplied_errors)):
+            ops = getattr(self, attr)
+            if not ops: continue
+            setattr(self, attr, [])
+            self.slots.acquire()
+            # Bản sao context để lượt ghi trong thread vẫn được tính cho hàm gọi (tracked_fn)
+            self.futures.append(self.pool.submit(contextvars.copy_context().run, self._commit, ops, retry()))
+
+    def _commit(self, ops, retry):
+        try:
+            for attempt in range(self.retries + 1):
+                batch = self.db.batch()
+                for kind, ref, data, merge in ops:
+                    if kind == 'set': batch.set(ref, data, merge=merge)
+                    elif kind == 'update': batch.update(ref, data)
+                    else: batch.delete(ref)
+                try:
+                    batch.commit()
+                    with self.lock: self.written += len(ops)
+                    return
+                except retry as e:
+                    err = e
+                    if attempt < self.retries: time.sleep(min(30, 0.5 * 2 ** attempt) + random.random() / 2)
+                except Exception as e:
+                    err = e; break
+            msg = str(err) + (" (không rõ đã ghi hay chưa, không thử lại)" if isinstance(err, retryable_errors()) and not isinstance(err, retry) else "")
+            with self.lock: self.errors.extend((ref.path, msg) for _, ref, _, _ in ops)
+        finally: self.slots.release()
+
+    def close(self):
+        self.flush()
+        for f in self.futures: f.result()
+        self.pool.shutdown()
+        return self
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+STUDENT_PAGE = 200
+
+@tracked_fn
+def load_students_page(db, year, cls, search, cursor):
+    # 1 trang danh sách HS (phân trang theo cursor, chỉ lấy 4 field cần hiển thị)
+    q = db.collection('students').where('year', '==', year)
+    if cls != "Tất cả": q = q.where('cls', '==', cls)
+    if search:
+        field = 'id' if search[0].isdigit() else 'name'
+        q = q.where(field, '>=', search).where(field, '<=', search + '\uf8ff')
+        order = [field] if field == 'id' else ['name', 'id']
+    else: order = ['cls', 'name', 'id']
+    for f in order: q = q.order_by(f)
+    q = q.select(['id', 'name', 'cls', 'active'])
+    if cursor: q = q.start_after(cursor)
+    docs = [d.to_dict() for d in q.limit(STUDENT_PAGE + 1).stream()]
+    has_next = len(docs) > STUDENT_PAGE; docs = docs[:STUDENT_PAGE]
+    return {'docs': docs, 'has_next': has_next, 'next': {f: docs[-1].get(f) for f in order} if docs else None}
+
+def show_write_errors(w):
+    if w.errors:
+        st.error(f"⚠️ {len(w.errors)} thao tác ghi thất bại (đã thử lại). VD: " + "; ".join(f"{p}: {e}" for p, e in w.errors[:3]))
+        if any(p.startswith('stats/') for p, _ in w.errors): st.warning("Thống kê có thể bị lệch: vào tab THỐNG KÊ, bấm \"Tính lại thống kê của lớp này\".")
+
+KEYS_ONLY = ['__name__']  # projection chỉ lấy khóa document, không tải dữ liệu
+DELETE_PAGE = 2000
+
+def count_query(query):
+    # Đếm phía server (aggregation), không đọc document; None nếu SDK/server không hỗ trợ
+    try: return int(query.count().get()[0][0].value)
+    except Exception: return None
+
+@tracked_fn
+def delete_data_year(db, collection, year, cls, sem=None, progress=None):
+    # Quét theo trang chỉ lấy khóa, xóa song song trong lúc quét trang tiếp theo.
+    # Chạy lại sau khi bị ngắt giữa chừng sẽ chỉ gặp các document còn sót -> tự tiếp tục.
     cnt = 0
     try:
         ref = db.collection(collection)
@@ -122,91 +656,617 @@ def delete_data_year(db, collection, year, cls, sem=None):
         if cls != "Tất cả": query = query.where('cls', '==', cls)
         if sem: query = query.where('sem', '==', sem)
         
-        batch = db.batch(); b_cnt = 0
-        for doc in query.stream():
-            batch.delete(doc.reference)
-            b_cnt += 1; cnt += 1
-            if b_cnt >= 400: batch.commit(); batch = db.batch(); b_cnt = 0
-        if b_cnt > 0: batch.commit()
+        total = count_query(query) if progress else None
+        with ParallelWriter(db) as w:
+            last = None
+            while True:
+                q = query.select(KEYS_ONLY).limit(DELETE_PAGE)
+                if last: q = q.start_after(last)
+                snaps = list(q.stream())
+                if not snaps: break
+                for d in snaps: w.delete(d.reference)
+                last = snaps[-1]
+                if progress: progress(collection, sem, w.written, total)
+        cnt = w.written
+        if progress: progress(collection, sem, cnt, total)
+        show_write_errors(w)
+
+        # Đồng bộ phiếu điểm dựng sẵn
+        if collection == 'students':
+            students_changed(db, year)
+            delete_data_year(db, 'reports', year, cls, progress=progress)
+        elif (collection, sem) in REPORT_FIELD:
+            rep_sem, rep_field = REPORT_FIELD[(collection, sem)]
+            query = db.collection('reports').where('year', '==', year).where('sem', '==', rep_sem)
+            if cls != "Tất cả": query = query.where('cls', '==', cls)
+            with ParallelWriter(db) as w:
+                for doc in query.select(KEYS_ONLY).stream():
+                    w.update(doc.reference, {rep_field: {}})
+            show_write_errors(w)
+        # Thống kê của phạm vi vừa xóa không còn dữ liệu gốc -> xóa theo
+        if collection in STATS_KIND:
+            query = db.collection('stats').where('year', '==', year).where('kind', '==', STATS_KIND[collection])
+            if cls != "Tất cả": query = query.where('cls', '==', cls)
+            if sem: query = query.where('sem', '==', sem)
+            with ParallelWriter(db) as w:
+                for doc in query.select(KEYS_ONLY).stream(): w.delete(doc.reference)
+            show_write_errors(w)
+        if collection != 'reports': data_changed(db, year, cls)
     except Exception as e: st.error(f"Lỗi xóa: {e}")
     return cnt
 
+# Sheet không phải môn học (kể cả sheet "Tổng kết" trong file do XUẤT EXCEL tạo ra)
+def skip_sheet(sname): return any(x in unicodedata.normalize('NFC', str(sname)).lower() for x in ["hướng dẫn", "bìa", "tổng kết"])
+
+def parse_score_workbook(data, year, sem, cls):
+    # Hàm thuần: {sheet: DataFrame} -> ({mã HS: tên}, {doc_id scores: bản ghi})
+    students = {}; recs = {}
+    for sname, df in data.items():
+        if skip_sheet(sname): continue
+        sub = str(sname).strip().replace("/", "-")
+        sheet = parse_score_sheet(df, sem)
+        if sheet.empty: continue
+        for ma, ten in zip(sheet['id'], sheet['name']):
+            if ten is not None: students[ma] = ten
+        sheet = sheet.drop(columns='name').assign(year=year, sem=sem, cls=cls, sub=sub)
+        for rec in sheet[SCORE_FIELDS].to_dict('records'):
+            recs[f"{rec['id']}_{year}_{sem}_{sub}"] = rec
+    return students, recs
+
+# Workbook lớn: có thể đọc mỗi sheet môn trên 1 tiến trình riêng. TẮT mặc định, bật bằng DIEM_PARSE_WORKERS=<số tiến trình>.
+# Tiến trình con phải dùng 'spawn' (tiến trình Streamlit có nhiều thread, fork không an toàn), mỗi tiến trình nạp lại
+# app.py + pandas (~100 MB); trên máy 1 nhân đo được đọc song song còn chậm hơn tuần tự (381 so với 415 dòng/s).
+# Pool tạo riêng cho từng file và đóng ngay khi đọc xong -> không giữ tiến trình con trong bộ nhớ giữa các lần nạp.
+PARSE_POOL_MIN_ROWS = 3000
+
+def cpu_quota():
+    # Số nhân thực được dùng: sched_getaffinity không tính hạn mức CPU của cgroup (container Render...) -> đọc thêm
+    # cpu.max (cgroup v2) hoặc cpu.cfs_quota_us / cpu.cfs_period_us (cgroup v1)
+    try: cpus = len(os.sched_getaffinity(0))
+    except AttributeError: cpus = os.cpu_count() or 1
+    def read(path):
+        with open(path) as f: return f.read().split()
+    try:
+        try: quota, period = read('/sys/fs/cgroup/cpu.max')[:2]
+        except OSError: quota, period = read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')[0], read('/sys/fs/cgroup/cpu/cpu.cfs_period_us')[0]
+        if quota not in ('max', '-1'): cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError, IndexError): pass
+    return cpus
+
+def parse_pool_workers():
+    # 1 = đọc tuần tự
+    try: want = int(os.environ.get("DIEM_PARSE_WORKERS") or 0)
+    except ValueError: want = 0
+    return max(1, min(want, cpu_quota()))
+
+def parse_score_sheets(data, year, sem, cls, pool=None):
+    # {sheet: DataFrame} -> ({sheet: (students, recs)}, {sheet: lỗi}); lỗi 1 sheet không làm hỏng cả file.
+    # pool=None: tự chọn theo kích thước workbook; True/False: ép dùng / không dùng tiến trình con (bench.py).
+    # Chỉ dùng tiến trình con khi đã bật DIEM_PARSE_WORKERS và được cấp từ 2 nhân.
+    sheets = {n: df for n, df in data.items() if not skip_sheet(n)}
+    futs, ex, workers = {}, None, parse_pool_workers()
+    if pool is None: pool = len(sheets) > 1 and sum(len(df) for df in sheets.values()) >= PARSE_POOL_MIN_ROWS
+    if pool and workers > 1 and len(sheets) > 1:
+        try:
+            ex = ProcessPoolExecutor(max_workers=min(workers, len(sheets)), mp_context=multiprocessing.get_context('spawn'))
+            futs = {n: ex.submit(parse_score_workbook, {n: df}, year, sem, cls) for n, df in sheets.items()}
+        except Exception: futs = {}
+    out, errors = {}, {}
+    try:
+        for n, df in sheets.items():
+            try:
+                if n in futs:
+                    try: out[n] = futs[n].result(); continue
+                    except Exception: pass  # lỗi phía pool (VD tiến trình con chết) -> đọc lại tuần tự để biết lỗi thật
+                out[n] = parse_score_workbook({n: df}, year, sem, cls)
+            except Exception as e: errors[n] = str(e)
+    finally:
+        if ex: ex.shutdown(cancel_futures=True)
+    return out, errors
+
+def parse_summary_table(df, year, sem, cls):
+    # Hàm thuần: bảng tổng kết -> {doc_id summary: (mã HS, kỳ, dữ liệu TK)}
+    if 'Mã học sinh' not in df.columns:
+        for i, r in df.iterrows():
+            if r.astype(str).str.contains("Mã học sinh").any(): df.columns = df.iloc[i]; df = df.iloc[i+1:]; break
+    df.columns = df.columns.str.strip()
+    has_loai = 'Loại TK' in df.columns
+    recs = {}
+    for _, row in df.iterrows():
+        ma = safe_str(row.get('Mã học sinh'))
+        if len(ma) > 3:
+            cur_sem = sem
+            if has_loai:
+                v = safe_str(row.get('Loại TK')).upper()
+                if '1' in v: cur_sem = 'HK1'
+                elif '2' in v: cur_sem = 'HK2'
+                elif 'CN' in v or 'NAM' in v: cur_sem = 'CN'
+            tk = {'ht': safe_str(row.get('Học tập')), 'rl': safe_str(row.get('Rèn luyện')),
+                  'v': safe_str(row.get('Vắng')), 'dh': safe_str(row.get('Danh hiệu')),
+                  'kq': safe_str(row.get('Kết quả'))}
+            recs[f"{ma}_{year}_{cur_sem}_sum"] = (ma, cur_sem, tk)
+    return recs
+
+# --- Thống kê lớp/môn: cộng dồn (số lượng, tổng, phân loại) -> cập nhật bằng chênh lệch mỗi lần nạp/xóa ---
+# Doc stats/{năm}_{lớp}_{kỳ}_{môn}: {'year','cls','sem','sub','kind','agg': {khóa: số}}
+# Khóa agg: 'n' (số bản ghi), 'tb|n' / 'tb|sum' (điểm số), 'tb|Giỏi'... (phân loại), 'tb#Đ' (điểm đánh giá bằng chữ)
+STAT_BINS = [(0, 'Kém'), (3.5, 'Yếu'), (5, 'TB'), (6.5, 'Khá'), (8, 'Giỏi')]
+STATS_KIND = {'scores': 'score', 'summary': 'summary'}
+STATS_TK = '__tk'  # "môn" của doc thống kê tổng kết
+
+def score_agg(rows):
+    # rows: các bản ghi điểm (dict có cls, sem, sub, tb, cn) -> {(lớp, kỳ, môn): Counter}
+    out = defaultdict(Counter)
+    if not rows: return out
+    df = pd.DataFrame.from_records(rows, columns=['cls', 'sem', 'sub', 'tb', 'cn']).fillna("")
+    keys = ['cls', 'sem', 'sub']
+    for k, n in df.groupby(keys).size().items(): out[k]['n'] += int(n)
+    edges = [b for b, _ in STAT_BINS] + [float('inf')]
+    for f in ('tb', 'cn'):
+        num = pd.to_numeric(df[f].astype(str).str.replace(',', '.', regex=False), errors='coerce')
+        g = df[keys].assign(v=num, bin=pd.cut(num, edges, right=False, labels=[l for _, l in STAT_BINS]))
+        for k, r in g.groupby(keys)['v'].agg(['count', 'sum']).iterrows():
+            if r['count']: out[k][f'{f}|n'] += int(r['count']); out[k][f'{f}|sum'] += float(r['sum'])
+        for (*k, b), n in g.groupby(keys + ['bin'], observed=True).size().items(): out[tuple(k)][f'{f}|{b}'] += int(n)
+        txt = df[num.isna() & (df[f] != "")]
+        for (*k, v), n in txt.groupby(keys + [f]).size().items(): out[tuple(k)][f'{f}#{v}'] += int(n)
+    return out
+
+def summary_agg(rows):
+    # rows: các bản ghi tổng kết (dict có cls, sem, ht, dh) -> {(lớp, kỳ, STATS_TK): Counter}
+    out = defaultdict(Counter)
+    if not rows: return out
+    df = pd.DataFrame.from_records(rows, columns=['cls', 'sem', 'ht', 'dh']).fillna("")
+    for (c, s), n in df.groupby(['cls', 'sem']).size().items(): out[(c, s, STATS_TK)]['n'] += int(n)
+    for f in ('ht', 'dh'):
+        for (c, s, v), n in df[df[f] != ""].groupby(['cls', 'sem', f]).size().items(): out[(c, s, STATS_TK)][f'{f}#{v}'] += int(n)
+    return out
+
+def apply_stats(db, w, year, kind, new, old):
+    # Cộng (new - old) vào các doc stats liên quan bằng Increment phía server: không đọc trước,
+    # nhiều job/admin cùng ghi 1 doc không mất lượt cập nhật. Doc về n = 0 được giữ lại, màn hình thống kê bỏ qua.
+    delta = defaultdict(Counter)
+    for k, c in new.items(): delta[k].update(c)
+    for k, c in old.items(): delta[k].subtract(c)
+    for (c, s, sub), d in delta.items():
+        agg = {k: fs_transforms.Increment(v) for k, v in d.items() if v}
+        if not agg: continue
+        w.set(db.collection('stats').document(f"{year}_{c}_{s}_{sub}"), {'year': year, 'cls': c, 'sem': s, 'sub': sub, 'kind': kind, 'agg': agg}, merge=True, idempotent=False)
+
+def write_students(db, w, year, cls, students):
+    # Tài khoản HS trong file: 1 lượt get_all, chỉ ghi HS mới / đổi tên, đổi lớp -> Counter new_students
+    stats = Counter()
+    old_st = fetch_docs(db, 'students', [f"{ma}_{year}" for ma in students], ['name', 'cls'])
+    for ma, ten in students.items():
+        doc_st_id = f"{ma}_{year}"
+        st_data = {'id': ma, 'name': ten, 'cls': cls, 'year': year}
+        if doc_st_id not in old_st: st_data['active'] = 0; stats['new_students'] += 1
+        elif old_st[doc_st_id] == {'name': ten, 'cls': cls}: continue
+        w.set(db.collection('students').document(doc_st_id), st_data, merge=True)
+    return stats
+
+def write_scores(db, w, year, sem, cls, students, recs, reports=True):
+    # Chỉ ghi bản ghi mới/có thay đổi qua writer w -> Counter inserted / updated / unchanged
+    stats = write_students(db, w, year, cls, students); changed = []
+    old_fp = fetch_docs(db, 'scores', list(recs), ['fp', 'cls', 'sem', 'sub', 'tb', 'cn'])
+    for doc_id, rec in recs.items():
+        fp = record_fp(rec)
+        if doc_id not in old_fp: stats['inserted'] += 1
+        elif old_fp[doc_id].get('fp') == fp: stats['unchanged'] += 1; continue
+        else: stats['updated'] += 1
+        w.set(db.collection('scores').document(doc_id), {**rec, 'fp': fp}); changed.append(doc_id)
+    apply_stats(db, w, year, 'score', score_agg([recs[i] for i in changed]), score_agg([old_fp[i] for i in changed if i in old_fp]))
+    if reports: write_reports(db, w, year, sem, cls, recs)
+    return stats
+
+def seed_reports(db, year, sem, cls, have, ids):
+    # Phiếu mới / thiếu phần (HS mới, hoặc dữ liệu nạp trước khi có phiếu dựng sẵn): lấy phần còn thiếu từ scores / summary,
+    # mỗi collection 1 query cho cả lớp. have = {doc_id reports: các phần đã có}. -> {doc_id reports: {phần: dữ liệu}}
+    seed = {}
+    for ma in ids:
+        doc_rep = f"{ma}_{year}_{sem}"
+        parts = [p for p in REPORT_PARTS[sem] if p not in have.get(doc_rep, {})]
+        if parts: seed[doc_rep] = {p: {} for p in parts}
+    def scope(coll): return db.collection(coll).where('year', '==', year).where('cls', '==', cls)
+    if any('subs' in x for x in seed.values()):
+        for r in (d.to_dict() for d in scope('scores').where('sem', '==', sem).select(['id'] + REPORT_ROW_FIELDS).stream()):
+            x = seed.get(f"{r.get('id')}_{year}_{sem}")
+            if x and 'subs' in x: x['subs'][r.get('sub')] = {k: r.get(k, '') for k in REPORT_ROW_FIELDS}
+    tk_part = {s: f for (c, s), (rs, f) in REPORT_FIELD.items() if c == 'summary' and rs == sem}
+    if any(p in x for x in seed.values() for p in tk_part.values()):
+        for r in (d.to_dict() for d in scope('summary').where('sem', 'in', list(tk_part)).select(['id', 'sem'] + TK_FIELDS).stream()):
+            x = seed.get(f"{r.get('id')}_{year}_{sem}"); p = tk_part.get(r.get('sem'))
+            if x and p in x: x[p] = {k: r.get(k, '') for k in TK_FIELDS}
+    return seed
+
+def write_reports(db, w, year, sem, cls, recs):
+    # Phiếu điểm dựng sẵn để màn hình HS chỉ cần 1 lần đọc; recs = điểm các môn trong file vừa nạp.
+    # Chỉ ghi các môn có thay đổi (merge theo môn) -> các môn nạp từ file khác vẫn giữ nguyên.
+    reports = {}
+    for rec in recs.values(): reports.setdefault(rec['id'], {})[rec['sub']] = {k: rec[k] for k in REPORT_ROW_FIELDS}
+    old_rep = fetch_docs(db, 'reports', [f"{ma}_{year}_{sem}" for ma in reports], ['cls', *REPORT_PARTS[sem]])
+    seed = seed_reports(db, year, sem, cls, old_rep, reports)
+    for ma, subs in reports.items():
+        doc_rep = f"{ma}_{year}_{sem}"
+        old, extra = old_rep.get(doc_rep, {}), seed.get(doc_rep, {})
+        subs = {**extra.pop('subs', {}), **subs}
+        changed = {sub: row for sub, row in subs.items() if old.get('subs', {}).get(sub) != row}
+        if not changed and not extra and old.get('cls') == cls: continue
+        data = {'id': ma, 'year': year, 'sem': sem, 'cls': cls, **extra}
+        if changed: data['subs'] = changed  # map rỗng trong set(merge=True) sẽ xóa cả field trên Firestore
+        w.set(db.collection('reports').document(doc_rep), data, merge=True)
+
+def write_summary(db, w, year, cls, recs):
+    stats = Counter(); changed = {}; reports = defaultdict(dict)  # {(mã HS, kỳ của phiếu): {phần: TK}}
+    old_fp = fetch_docs(db, 'summary', list(recs), ['fp', 'cls', 'sem', 'ht', 'dh'])
+    for doc_id, (ma, cur_sem, tk) in recs.items():
+        rec = {'id': ma, 'year': year, 'sem': cur_sem, 'cls': cls, **tk}
+        fp = record_fp(rec)
+        if doc_id not in old_fp: stats['inserted'] += 1
+        elif old_fp[doc_id].get('fp') == fp: stats['unchanged'] += 1
+        else: stats['updated'] += 1
+        if old_fp.get(doc_id, {}).get('fp') != fp:
+            w.set(db.collection('summary').document(doc_id), {**rec, 'fp': fp}); changed[doc_id] = rec
+        rep_sem, rep_field = REPORT_FIELD[('summary', cur_sem)]
+        reports[(ma, rep_sem)][rep_field] = tk
+    for rep_sem in sorted({s for _, s in reports}):
+        ids = [ma for ma, s in reports if s == rep_sem]
+        old_rep = fetch_docs(db, 'reports', [f"{ma}_{year}_{rep_sem}" for ma in ids], ['cls', *REPORT_PARTS[rep_sem]])
+        # Phần TK sắp ghi coi như đã có -> chỉ lấy thêm các phần khác còn thiếu
+        have = {f"{ma}_{year}_{rep_sem}": {**old_rep.get(f"{ma}_{year}_{rep_sem}", {}), **reports[(ma, rep_sem)]} for ma in ids}
+        seed = seed_reports(db, year, rep_sem, cls, have, ids)
+        for ma in ids:
+            doc_rep, parts = f"{ma}_{year}_{rep_sem}", reports[(ma, rep_sem)]
+            old = old_rep.get(doc_rep, {})
+            if doc_rep not in seed and old.get('cls') == cls and all(old.get(p) == v for p, v in parts.items()): continue
+            w.set(db.collection('reports').document(doc_rep), {'id': ma, 'year': year, 'sem': rep_sem, 'cls': cls, **seed.get(doc_rep, {}), **parts}, merge=True)
+    apply_stats(db, w, year, 'summary', summary_agg(list(changed.values())), summary_agg([old_fp[i] for i in changed if i in old_fp]))
+    return stats
+
+@tracked_fn
 def upload_firebase(db, file, year, sem, cls, type_file):
-    count = 0
+    # Trả về Counter: inserted / updated / unchanged (chỉ ghi bản ghi mới hoặc có thay đổi)
+    stats = Counter()
     try:
-        batch = db.batch(); b_cnt = 0
-        
         if type_file == 'score':
             data = load_excel_robust(file)
-            if not data: return 0
-            for sname, df in data.items():
-                if any(x in str(sname).lower() for x in ["hướng dẫn", "bìa"]): continue
-                h_idx = -1
-                for i, row in df.iterrows():
-                    if row.astype(str).str.contains("Mã học sinh", case=False).any(): h_idx = i; break
-                if h_idx != -1:
-                    df.columns = df.iloc[h_idx]; df = df.iloc[h_idx+1:]
-                    cols = df.columns.tolist()
-                    idx_ma = next((i for i,c in enumerate(cols) if "Mã học sinh" in str(c)), -1)
-                    if idx_ma != -1:
-                        for _, row in df.iterrows():
-                            ma = safe_str(row.iloc[idx_ma])
-                            if len(ma) > 3:
-                                try:
-                                    ten = safe_str(row.iloc[idx_ma-2])
-                                    doc_st_id = f"{ma}_{year}"
-                                    ref_st = db.collection('students').document(doc_st_id)
-                                    snap = ref_st.get()
-                                    st_data = {'id': ma, 'name': ten, 'cls': cls, 'year': year}
-                                    if not snap.exists: st_data['active'] = 0
-                                    batch.set(ref_st, st_data, merge=True)
-                                except: pass
-
-                                def g(o): 
-                                    try: return safe_str(row.iloc[idx_ma+o])
-                                    except: return ""
-                                sub = str(sname).strip().replace("/", "-")
-                                doc_id = f"{ma}_{year}_{sem}_{sub}"
-                                batch.set(db.collection('scores').document(doc_id), {
-                                    'id': ma, 'year': year, 'sem': sem, 'cls': cls, 'sub': sub,
-                                    'tx': "  ".join([g(k) for k in range(1,10) if g(k)]),
-                                    'gk': g(16), 'ck': g(26), 'tb': g(27), 
-                                    'cn': (g(28) if sem=='HK2' else "")
-                                })
-                                count += 1; b_cnt += 1
-                                if b_cnt >= 300: batch.commit(); batch = db.batch(); b_cnt = 0
-            batch.commit()
+            if not data: return stats
+            parsed, errors = parse_score_sheets(data, year, sem, cls)
+            students, recs = {}, {}
+            for s, r in parsed.values(): students.update(s); recs.update(r)
+            for sname, err in errors.items(): st.warning(f"Sheet '{sname}' lỗi, đã bỏ qua: {err}")
+            # Thiếu sheet thì phiếu điểm dựng sẵn sẽ thiếu môn -> giữ phiếu cũ, chờ nạp lại file đã sửa
+            with ParallelWriter(db) as w: stats = write_scores(db, w, year, sem, cls, students, recs, reports=not errors)
+            show_write_errors(w)
+            if errors: st.warning("Phiếu điểm của HS chưa được cập nhật do có sheet lỗi; sửa rồi nạp lại file.")
+            if stats['new_students']: students_changed(db, year)
         elif type_file == 'summary':
-            try: df = pd.read_excel(file)
-            except: df = pd.read_csv(file)
-            if 'Mã học sinh' not in df.columns:
-                for i, r in df.iterrows():
-                    if r.astype(str).str.contains("Mã học sinh").any(): df.columns = df.iloc[i]; df = df.iloc[i+1:]; break
-            df.columns = df.columns.str.strip()
-            has_loai = 'Loại TK' in df.columns
-            for _, row in df.iterrows():
-                ma = safe_str(row.get('Mã học sinh'))
-                if len(ma) > 3:
-                    cur_sem = sem
-                    if has_loai:
-                        v = safe_str(row.get('Loại TK')).upper()
-                        if '1' in v: cur_sem = 'HK1'
-                        elif '2' in v: cur_sem = 'HK2'
-                        elif 'CN' in v or 'NAM' in v: cur_sem = 'CN'
-                    doc_id = f"{ma}_{year}_{cur_sem}_sum"
-                    batch.set(db.collection('summary').document(doc_id), {
-                        'id': ma, 'year': year, 'sem': cur_sem, 'cls': cls,
-                        'ht': safe_str(row.get('Học tập')), 'rl': safe_str(row.get('Rèn luyện')),
-                        'v': safe_str(row.get('Vắng')), 'dh': safe_str(row.get('Danh hiệu')),
-                        'kq': safe_str(row.get('Kết quả'))
-                    })
-                    count += 1; b_cnt += 1
-                    if b_cnt >= 300: batch.commit(); batch = db.batch(); b_cnt = 0
-            batch.commit()
+            recs = parse_summary_table(load_table_robust(file), year, sem, cls)
+            with ParallelWriter(db) as w: stats = write_summary(db, w, year, cls, recs)
+            show_write_errors(w)
+        if stats['inserted'] or stats['updated']: data_changed(db, year, cls)
     except Exception as e: st.error(f"Lỗi: {e}")
-    return count
+    return stats
+
+# --- Hàng đợi nạp dữ liệu chạy nền: tiến độ, hủy, checkpoint từng sheet ---
+# Checkpoint lưu ở upload_jobs/{job_id}; job_id = hash(nội dung file + năm/kỳ/lớp/loại)
+# -> nạp lại đúng file đó (kể cả sau khi server khởi động lại) sẽ tiếp tục từ sheet chưa xong.
+JOB_DIR = os.path.join(tempfile.gettempdir(), 'diem_jobs')
+
+class UploadJob:
+    def __init__(self, job_id, name, year, sem, cls, type_file):
+        self.id, self.name, self.year, self.sem, self.cls, self.type_file = job_id, name, year, sem, cls, type_file
+        self.status, self.created = 'queued', time.time()
+        self.done, self.sheets_total, self.stats, self.errors = [], 0, Counter(), {}  # errors: {sheet: lỗi}
+        self.cancel_evt, self.writer = threading.Event(), None
+        self.meter = Meter(Counter())  # lượt đọc/ghi Firestore của job (chạy ngoài mọi lượt chạy script)
+
+    @property
+    def path(self): return os.path.join(JOB_DIR, f"{self.id}.bin")
+
+    @property
+    def written(self): return self.stats['written'] + (self.writer.written if self.writer else 0)
+
+    def load(self, d):
+        self.done, self.stats, self.errors = list(d.get('done', [])), Counter(d.get('stats', {})), dict(d.get('errors', {}))
+
+    def checkpoint(self, db):
+        # Ghi đè cả doc (không merge): merge sẽ trộn map errors -> lỗi đã khắc phục vẫn còn trên Firestore
+        db.collection('upload_jobs').document(self.id).set({
+            'name': self.name, 'year': self.year, 'sem': self.sem, 'cls': self.cls, 'type': self.type_file,
+            'status': self.status, 'created': self.created, 'updated': time.time(),
+            'done': self.done, 'sheets_total': self.sheets_total, 'stats': dict(self.stats), 'errors': self.errors,
+        })
+
+    def _step(self, db, key, fn):
+        # 1 bước (1 sheet): ghi xong hết mới đánh dấu hoàn thành; lỗi chỉ ảnh hưởng bước đó
+        if key in self.done: return
+        try:
+            with ParallelWriter(db) as w:
+                self.writer = w; stats = fn(w)
+            self.writer = None; self.stats['written'] += w.written
+            if w.errors: self.errors[key] = f"{len(w.errors)} thao tác ghi lỗi, VD: {w.errors[0][1]}"
+            else: self.stats.update(stats); self.errors.pop(key, None); self.done.append(key)
+        except Exception as e: self.writer = None; self.errors[key] = str(e)
+        self.checkpoint(db)
+
+    def run(self, db):
+        # Lượt đọc/ghi của job tính cho "upload_job" trong tab HIỆU NĂNG và cho self.meter
+        tok = _current_fn.set('upload_job')
+        try: self._run(Tracked(_unwrap(db), self.meter))
+        finally: _current_fn.reset(tok)
+
+    def _run(self, db):
+        self.status = 'running'; self.errors.pop('__file__', None)
+        try:
+            with open(self.path, 'rb') as f: raw = io.BytesIO(f.read())
+            if self.type_file == 'score':
+                data = load_excel_robust(raw)
+                if not data: raise ValueError("Không đọc được file")
+                parsed, perr = parse_score_sheets(data, self.year, self.sem, self.cls)
+                self.sheets_total = len(parsed) + len(perr) + 2; all_students, all_recs = {}, {}
+                for students, recs in parsed.values(): all_students.update(students); all_recs.update(recs)
+                for sname, err in perr.items(): self.errors[str(sname)] = f"Lỗi đọc sheet: {err}"
+                # Tài khoản HS của cả file ghi 1 lần (1 lượt get_all), không lặp lại theo từng sheet
+                if not self.cancel_evt.is_set(): self._step(db, '__students__', lambda w: write_students(db, w, self.year, self.cls, all_students))
+                for sname, (_, recs) in parsed.items():
+                    if self.cancel_evt.is_set(): break
+                    self._step(db, str(sname), lambda w: write_scores(db, w, self.year, self.sem, self.cls, {}, recs, reports=False))
+                # Phiếu điểm cần đủ mọi môn -> dựng sau cùng, từ toàn bộ sheet đọc được
+                if not self.cancel_evt.is_set() and not self.errors:
+                    self._step(db, '__reports__', lambda w: write_reports(db, w, self.year, self.sem, self.cls, all_recs) or Counter())
+            else:
+                self.sheets_total = 1
+                recs = parse_summary_table(load_table_robust(raw), self.year, self.sem, self.cls)
+                self._step(db, '__summary__', lambda w: write_summary(db, w, self.year, self.cls, recs))
+            if self.stats['new_students']: students_changed(db, self.year)
+            if self.stats['inserted'] or self.stats['updated']: data_changed(db, self.year, self.cls)
+            self.status = 'cancelled' if self.cancel_evt.is_set() else 'failed' if self.errors else 'done'
+        except Exception as e: self.errors['__file__'] = str(e); self.status = 'failed'
+        try: self.checkpoint(db)
+        except Exception: pass
+        if self.status == 'done':
+            try: os.remove(self.path)
+            except OSError: pass
+
+@st.cache_resource
+def _job_queue():
+    return {'pool': ThreadPoolExecutor(max_workers=2), 'jobs': OrderedDict(), 'lock': threading.Lock()}
+
+def submit_upload(db, file, year, sem, cls, type_file):
+    raw = file_bytes(file)
+    job_id = hashlib.sha256(raw + f"|{year}|{sem}|{cls}|{type_file}".encode()).hexdigest()[:16]
+    q = _job_queue()
+    with q['lock']:
+        job = q['jobs'].get(job_id)
+        if job and job.status in ('queued', 'running'): return job
+        if job is None:
+            job = UploadJob(job_id, getattr(file, 'name', 'file'), year, sem, cls, type_file)
+            prev = db.collection('upload_jobs').document(job_id).get()
+            if prev.exists and prev.to_dict().get('status') != 'done': job.load(prev.to_dict())
+            q['jobs'][job_id] = job
+        elif job.status == 'done': job.load({})  # nạp lại file đã xong -> chạy lại từ đầu (bản ghi không đổi sẽ được bỏ qua)
+        os.makedirs(JOB_DIR, exist_ok=True)
+        with open(job.path, 'wb') as f: f.write(raw)
+        _enqueue(q, job, _unwrap(db))
+    return job
+
+def _enqueue(q, job, db):
+    job.cancel_evt.clear(); job.status = 'queued'
+    q['pool'].submit(job.run, db)
+
+def resume_upload(db, job):
+    q = _job_queue()
+    with q['lock']:
+        if job.status in ('queued', 'running'): return True
+        if not os.path.exists(job.path): return False
+        _enqueue(q, job, _unwrap(db))
+    return True
+
+JOB_LABELS = {'queued': '⏳ Đang chờ', 'running': '⚙️ Đang chạy', 'done': '✅ Xong', 'cancelled': '⛔ Đã hủy', 'failed': '❌ Có lỗi'}
+
+@st.fragment(run_every=2)
+def job_panel(db):
+    jobs = list(_job_queue()['jobs'].values())[::-1][:10]
+    if not jobs: return
+    st.markdown("**Tiến độ nạp dữ liệu:**")
+    for job in jobs:
+        kind = 'Tổng kết' if job.type_file == 'summary' else job.sem
+        st.markdown(f"{JOB_LABELS.get(job.status, job.status)} — **{job.name}** ({job.cls}, {kind}, {job.year})")
+        total = max(job.sheets_total, 1)
+        m = job.meter.run
+        st.progress(min(1.0, len(job.done) / total), text=f"{len(job.done)}/{job.sheets_total} bước · đã ghi {job.written} · {format_upload_stats(job.stats)}")
+        st.caption(f"Firestore: {m['reads']} lượt đọc, {m['writes']} lượt ghi, {m['queries']} query")
+        for sheet, err in job.errors.items(): st.caption(f"⚠️ {sheet}: {err}")
+        c1, c2 = st.columns(2)
+        if job.status in ('queued', 'running') and c1.button("Hủy", key=f"cancel_{job.id}"): job.cancel_evt.set()
+        if job.status in ('cancelled', 'failed') and c2.button("Tiếp tục", key=f"resume_{job.id}"):
+            if not resume_upload(db, job): st.warning("Không còn file tạm trên máy chủ, hãy tải lại đúng file này để tiếp tục.")
+
+def format_upload_stats(c):
+    return f"Đã lưu {c['inserted'] + c['updated']} bản ghi (mới {c['inserted']}, cập nhật {c['updated']}, không đổi {c['unchanged']})."
+
+# --- Xuất Excel: đọc theo trang, ghi thẳng ra workbook write-only (bộ nhớ không tăng theo số bản ghi) ---
+EXPORT_PAGE = 1000
+
+def iter_query(query, fields, page=EXPORT_PAGE):
+    # Duyệt toàn bộ kết quả query theo trang (cursor), chỉ lấy các field cần
+    last = None
+    while True:
+        q = query.select(fields).limit(page)
+        if last: q = q.start_after(last)
+        snaps = list(q.stream())
+        yield from snaps
+        if len(snaps) < page: return
+        last = snaps[-1]
+
+def num_or_str(v):
+    try: return float(v) if v not in ("", None) else None
+    except (TypeError, ValueError): return v
+
+def export_workbook(db, year, cls, sem, out):
+    # 1 sheet / môn, đúng bố cục file nhập (tên ở cột -2, lớp ở cột -1, điểm ở cột +1..+28 so với "Mã học sinh")
+    # + sheet "Tổng kết" cùng cột với file tổng kết; có 1 dòng tiêu đề phía trên như file gốc. Trả về số bản ghi đã xuất.
+    from openpyxl import Workbook
+    def where(coll):
+        q = db.collection(coll).where('year', '==', year)
+        return q.where('cls', '==', cls) if cls != "Tất cả" else q
+    names = {r.get('id'): r.get('name', '') for r in (d.to_dict() for d in iter_query(where('students'), ['id', 'name']))}
+    wb = Workbook(write_only=True); sheets = {}; n = 0
+    width = 4 + OFF_CN
+    head = [None] * width; head[0], head[1], head[2], head[3] = "STT", "Họ và tên", "Lớp", "Mã học sinh"
+    for i, o in enumerate(OFF_TX, start=1): head[3 + o] = f"TX{i}"
+    head[3 + OFF_GK], head[3 + OFF_CK], head[3 + OFF_TB], head[3 + OFF_CN] = "GK", "CK", "TB", "CN"
+    for d in iter_query(where('scores').where('sem', '==', sem), SCORE_FIELDS):
+        r = d.to_dict(); sub = r.get('sub', '')
+        if sub not in sheets:
+            ws = sheets[sub] = wb.create_sheet(str(sub)[:31]); ws.append([f"BẢNG ĐIỂM {sub} - {cls} - {sem} - {year}"]); ws.append(head); ws.stt = 0
+        ws = sheets[sub]; ws.stt += 1
+        row = [None] * width
+        row[0], row[1], row[2], row[3] = ws.stt, names.get(r.get('id'), ''), r.get('cls'), r.get('id')
+        for o, v in zip(OFF_TX, str(r.get('tx', '')).split()): row[3 + o] = num_or_str(v)
+        for o, k in [(OFF_GK, 'gk'), (OFF_CK, 'ck'), (OFF_TB, 'tb'), (OFF_CN, 'cn')]: row[3 + o] = num_or_str(r.get(k))
+        ws.append(row); n += 1
+    ws = wb.create_sheet("Tổng kết")
+    ws.append([f"TỔNG KẾT - {cls} - {sem} - {year}"]); ws.append(["Mã học sinh", "Họ và tên", "Lớp", "Loại TK", "Học tập", "Rèn luyện", "Vắng", "Danh hiệu", "Kết quả"])
+    sems = [sem, 'CN'] if sem == 'HK2' else [sem]
+    for d in iter_query(where('summary').where('sem', 'in', sems), ['id', 'cls', 'sem', 'ht', 'rl', 'v', 'dh', 'kq']):
+        r = d.to_dict()
+        ws.append([r.get('id'), names.get(r.get('id'), ''), r.get('cls'), r.get('sem'), r.get('ht'), r.get('rl'), num_or_str(r.get('v')), r.get('dh'), r.get('kq')])
+        n += 1
+    wb.save(out)
+    return n
+
+@tracked_fn
+def rebuild_stats(db, year, cls):
+    # Tính lại toàn bộ thống kê của năm/lớp từ dữ liệu gốc (dữ liệu nạp trước khi có thống kê, hoặc sau lỗi ghi)
+    def scope(coll):
+        q = db.collection(coll).where('year', '==', year)
+        return q.where('cls', '==', cls) if cls != "Tất cả" else q
+    scores = [d.to_dict() for d in iter_query(scope('scores'), ['cls', 'sem', 'sub', 'tb', 'cn'])]
+    summary = [d.to_dict() for d in iter_query(scope('summary'), ['cls', 'sem', 'ht', 'dh'])]
+    with ParallelWriter(db) as w:
+        for d in iter_query(scope('stats'), KEYS_ONLY): w.delete(d.reference)
+    show_write_errors(w)
+    with ParallelWriter(db) as w:
+        apply_stats(db, w, year, 'score', score_agg(scores), {})
+        apply_stats(db, w, year, 'summary', summary_agg(summary), {})
+    show_write_errors(w)
+    return len(scores) + len(summary)
+
+def stats_tables(docs):
+    # Các doc stats của 1 lớp/kỳ -> (bảng môn, bảng cả năm, bảng tổng kết) dạng DataFrame
+    bins = [l for _, l in STAT_BINS[::-1]]
+    def table(rows):
+        df = pd.DataFrame(rows).T
+        if df.empty: return df
+        counts = [c for c in df.columns if c != 'ĐTB']
+        df[counts] = df[counts].fillna(0).astype(int)
+        return df
+    def row(a, f):
+        n = a.get(f'{f}|n', 0)
+        r = {'Số HS': a.get('n', 0), 'ĐTB': round(a.get(f'{f}|sum', 0) / n, 2) if n else None}
+        r.update({b: a.get(f'{f}|{b}', 0) for b in bins})
+        r.update({k.split('#', 1)[1]: v for k, v in a.items() if k.startswith(f'{f}#') and v})
+        return r
+    subs = sorted((d for d in docs if d.get('kind') == 'score'), key=lambda d: (sub_priority(d['sub']), d['sub']))
+    tb = table({d['sub']: row(d['agg'], 'tb') for d in subs})
+    cn = table({d['sub']: row(d['agg'], 'cn') for d in subs if any(v for k, v in d['agg'].items() if k.startswith(('cn|n', 'cn#')))})
+    names = {'ht': 'Học tập', 'dh': 'Danh hiệu'}
+    tk = table({d['sem']: {f"{names[k.split('#', 1)[0]]}: {k.split('#', 1)[1]}": v for k, v in d['agg'].items() if '#' in k and v}
+                for d in docs if d.get('kind') == 'summary'}).T
+    return tb, cn, tk
+
+# --- Ghép mã HS: chỉ mục tên chuẩn hóa dựng 1 lần, đọc cột tên bằng iter_rows, chỉ ghi vào ô khớp ---
+MERGE_HEAD_ROWS = 20
+
+def norm_name(val):
+    # Chuẩn hóa tên để so khớp: Unicode NFC, chữ thường, gộp khoảng trắng
+    if val is None or (not isinstance(val, str) and pd.isna(val)): return ""
+    return " ".join(unicodedata.normalize('NFC', str(val)).lower().split())
+
+def build_name_index(df):
+    # File mã HS -> ({tên chuẩn hóa: mã}, {tên trùng: [mã...]}); tên trùng không được ghép tự động
+    if 'Mã học sinh' not in df.columns or 'Họ và tên' not in df.columns:
+        for i, r in df.iterrows():
+            if r.astype(str).str.contains("Mã học sinh").any(): df.columns = df.iloc[i]; df = df.iloc[i+1:]; break
+        df.columns = [str(c).strip() for c in df.columns]
+        if 'Mã học sinh' not in df.columns or 'Họ và tên' not in df.columns: raise ValueError("File mã HS cần có cột 'Họ và tên' và 'Mã học sinh'")
+    ids = defaultdict(list)
+    for ten, ma in zip(df['Họ và tên'], df['Mã học sinh']):
+        ten, ma = norm_name(ten), safe_str(ma)
+        if ten and ma and ma not in ids[ten]: ids[ten].append(ma)
+    return {k: v[0] for k, v in ids.items() if len(v) == 1}, {k: v for k, v in ids.items() if len(v) > 1}
+
+def merge_ids(raw, index, dups):
+    # 1 workbook điểm (.xlsx, giữ nguyên định dạng) -> (bytes sau khi ghép, báo cáo từng sheet)
+    from openpyxl import load_workbook
+    wb = load_workbook(io.BytesIO(raw)); report = []
+    for ws in wb.worksheets:
+        head = col_name = col_id = None
+        for r, row in enumerate(ws.iter_rows(max_row=MERGE_HEAD_ROWS, values_only=True), start=1):
+            cells = [norm_name(v) for v in row]
+            col_name = next((c for c, v in enumerate(cells, start=1) if "họ và tên" in v or "họ tên" in v), None)
+            col_id = next((c for c, v in enumerate(cells, start=1) if "mã học sinh" in v), None)
+            if col_name and col_id: head = r; break
+        if not head: report.append({'Sheet': ws.title, 'Khớp': 0, 'Không khớp': 0, 'Trùng tên': 0, 'Ghi chú': "Không thấy cột 'Họ và tên' / 'Mã học sinh'", 'missed': []}); continue
+        hits, missed, dup = [], [], []
+        names = ws.iter_rows(min_row=head + 1, min_col=col_name, max_col=col_name, values_only=True)
+        for r, (val,) in enumerate(names, start=head + 1):
+            ten = norm_name(val)
+            if not ten: continue
+            if ten in index: hits.append((r, index[ten]))
+            elif ten in dups: dup.append(str(val).strip())
+            else: missed.append(str(val).strip())
+        for r, ma in hits: ws.cell(row=r, column=col_id).value = ma
+        report.append({'Sheet': ws.title, 'Khớp': len(hits), 'Không khớp': len(missed), 'Trùng tên': len(dup), 'Ghi chú': "", 'missed': missed + [f"{t} (trùng tên)" for t in dup]})
+    out = io.BytesIO(); wb.save(out)
+    return out.getvalue(), report
+
+@tracked_fn
+def load_student_result(db, mid, year, sem):
+    # Phiếu điểm 1 HS/1 kỳ -> (các dòng điểm đã sắp xếp, TK kỳ, TK cả năm nếu là HK2)
+    m = mirror_for(db, year)
+    def doc(coll, doc_id):
+        if m: return m.get(coll, doc_id)
+        snap = db.collection(coll).document(doc_id).get()
+        return snap.to_dict() if snap.exists else None
+    def by_sub(rows): return sorted(rows, key=lambda r: (sub_priority(r.get('sub')), str(r.get('sub'))))
+    rep_d = doc('reports', f"{mid}_{year}_{sem}")
+    if rep_d is not None: return by_sub(rep_d.get('subs', {}).values()), rep_d.get('summary', {}), rep_d.get('cn', {}) if sem == 'HK2' else {}
+    
+    # Dữ liệu tải lên trước khi có phiếu dựng sẵn: đọc trực tiếp như cũ
+    if m: found = m.find('scores', mid, sem)
+    else: found = [d.to_dict() for d in db.collection('scores').where('id', '==', mid).where('year', '==', year).where('sem', '==', sem).stream()]
+    def summary(s): return doc('summary', f"{mid}_{year}_{s}_sum") or {}
+    return by_sub(found), summary(sem), summary('CN') if sem == 'HK2' else {}
+
+RESULT_CACHE_SIZE = 8  # số phiếu điểm (mã, năm, kỳ) giữ lại trong 1 phiên
+
+def student_result(db, mid, year, sem, cls):
+    # Phiếu điểm đã dựng sẵn bảng (DataFrame, TK kỳ, TK cả năm), lưu theo phiên;
+    # chỉ đọc lại Firestore khi thế hệ dữ liệu của lớp đổi (xem data_changed)
+    cache = st.session_state.setdefault('result_cache', OrderedDict())
+    gen = get_settings(db).get(f"gen_{year}_{cls}"); key = (mid, year, sem)
+    hit = cache.get(key)
+    if hit and hit[0] == gen: cache.move_to_end(key); return hit[1]
+    rows, tk_d, cn_d = load_student_result(db, mid, year, sem)
+    table = None
+    if rows:
+        df = pd.DataFrame(rows)
+        df['STT'] = range(1, len(df)+1)
+        rn = {'sub': 'Môn', 'tx': 'TX', 'gk': 'GK', 'ck': 'CK', 'tb': 'TB', 'cn': 'CN'}
+        cols = ['STT', 'Môn', 'TX', 'GK', 'CK', 'TB']
+        if sem == 'HK2': cols.append('CN')
+        table = df.rename(columns=rn).reindex(columns=cols).set_index('STT')
+    res = (table, tk_d, cn_d)
+    if cls:
+        cache[key] = (gen, res)
+        while len(cache) > RESULT_CACHE_SIZE: cache.popitem(last=False)
+    return res
 
 # --- 4. ADMIN UI ---
+@tracked_fn
 def view_admin(db):
     st.markdown('<div class="main-header">🛠️ QUẢN TRỊ VIÊN</div>', unsafe_allow_html=True)
     if st.button("Đăng xuất"): st.session_state.page = 'login'; st.rerun()
@@ -231,7 +1291,7 @@ def view_admin(db):
                 st.success(f"Đã cập nhật phí thành {f'{int(fee_input):,}'.replace(',', '.')} VNĐ!"); st.rerun()
 
         st.markdown("---")
-        t1, t2, t3 = st.tabs(["UPLOADER", "KÍCH HOẠT", "XÓA DỮ LIỆU"])
+        t1, t2, t3, t4, t5, t6 = st.tabs(["UPLOADER", "KÍCH HOẠT", "XÓA DỮ LIỆU", "HIỆU NĂNG", "XUẤT EXCEL", "THỐNG KÊ"])
         
         with t1:
             st.caption(f"Upload vào năm: **{year_sel}**")
@@ -242,28 +1302,36 @@ def view_admin(db):
             tk = st.file_uploader(f"Tổng Kết {cls}", key="tk")
             
             if st.button("LƯU DỮ LIỆU", type="primary"):
-                with st.spinner(f"Đang xử lý {year_sel}..."):
-                    c = 0
-                    if f1: c += upload_firebase(db, f1, year_sel, "HK1", cls, 'score')
-                    if f2: c += upload_firebase(db, f2, year_sel, "HK2", cls, 'score')
-                    if tk: c += upload_firebase(db, tk, year_sel, "HK1", cls, 'summary')
-                    st.success(f"Đã lưu {c} bản ghi.")
+                # Chạy nền: tải lại trang hay quá thời gian request không làm hỏng lượt nạp
+                for f, sem, kind in [(f1, "HK1", 'score'), (f2, "HK2", 'score'), (tk, "HK1", 'summary')]:
+                    if f: submit_upload(db, f, year_sel, sem, cls, kind)
+                if f1 or f2 or tk: st.success("Đã đưa vào hàng đợi, theo dõi tiến độ bên dưới.")
+            
+            job_panel(db)
 
         with t2:
-            flt = st.selectbox("Lọc Lớp:", ["Tất cả"] + [f"Lớp {i}" for i in range(6, 13)])
-            ref = db.collection('students').where('year', '==', year_sel)
-            if flt != "Tất cả": ref = ref.where('cls', '==', flt)
+            c_f, c_s = st.columns(2)
+            flt = c_f.selectbox("Lọc Lớp:", ["Tất cả"] + [f"Lớp {i}" for i in range(6, 13)])
+            search = c_s.text_input("Tìm Mã HS / Họ tên (phần đầu):").strip()
             
-            docs = list(ref.stream())
-            data = [{"id_doc": d.id, **d.to_dict()} for d in docs]
+            # Cache các trang đã tải trong session, chỉ đọc Firestore khi sang trang mới
+            key = (year_sel, flt, search)
+            if st.session_state.get('act_key') != key:
+                st.session_state.act_key = key; st.session_state.act_pages = []; st.session_state.act_page = 0
+            pages = st.session_state.act_pages; page = st.session_state.act_page
+            if page >= len(pages):
+                cursor = pages[-1]['next'] if pages else None
+                pages.append(load_students_page(db, year_sel, flt, search, cursor))
+            cur = pages[page]
             
-            if data:
-                df = pd.DataFrame(data)
+            if cur['docs']:
+                df = pd.DataFrame(cur['docs'])
+                for c in ['id', 'name', 'cls']:
+                    if c not in df.columns: df[c] = ""
                 if 'active' not in df.columns: df['active'] = 0
                 df['active'] = df['active'].apply(lambda x: bool(x))
                 
-                df = df.sort_values(by=['cls', 'name'])
-                df.insert(0, 'STT', range(1, len(df) + 1))
+                df.insert(0, 'STT', range(page * STUDENT_PAGE + 1, page * STUDENT_PAGE + len(df) + 1))
                 
                 edited = st.data_editor(df[['active', 'STT', 'id', 'name', 'cls']], 
                                       column_config={
@@ -273,17 +1341,31 @@ def view_admin(db):
                                           "name": st.column_config.TextColumn("Họ tên", disabled=True),
                                           "cls": st.column_config.TextColumn("Lớp", disabled=True)
                                       },
-                                      hide_index=True, use_container_width=True)
+                                      hide_index=True, use_container_width=True, key=f"act_{key}_{page}")
+                
+                c_prev, c_info, c_next, c_reload = st.columns(4)
+                if c_prev.button("◀ Trang trước", disabled=page == 0): st.session_state.act_page -= 1; st.rerun()
+                c_info.markdown(f"Trang **{page + 1}**")
+                if c_next.button("Trang sau ▶", disabled=not cur['has_next']): st.session_state.act_page += 1; st.rerun()
+                if c_reload.button("🔄 Tải lại"): st.session_state.act_key = None; st.rerun()
                 
                 if st.button("LƯU TRẠNG THÁI"):
-                    batch = db.batch(); b_cnt = 0
-                    for i, r in edited.iterrows():
-                        doc_key = f"{r['id']}_{year_sel}"
-                        batch.update(db.collection('students').document(doc_key), {'active': 1 if r['active'] else 0})
-                        b_cnt += 1
-                        if b_cnt >= 300: batch.commit(); batch = db.batch(); b_cnt = 0
-                    batch.commit()
-                    st.success("Đã lưu!")
+                    # Chỉ ghi những HS có trạng thái khác với dữ liệu vừa tải từ Firestore
+                    changed = edited[edited['active'].astype(bool).to_numpy() != df['active'].to_numpy()]
+                    if changed.empty: st.info("Không có thay đổi nào.")
+                    else:
+                        with ParallelWriter(db) as w:
+                            for ma, act in zip(changed['id'], changed['active']):
+                                w.update(db.collection('students').document(f"{ma}_{year_sel}"), {'active': 1 if act else 0})
+                        show_write_errors(w)
+                        n_on = int(changed['active'].astype(bool).sum()); n_off = len(changed) - n_on
+                        if w.errors: st.session_state.act_key = None
+                        else:
+                            new_act = dict(zip(changed['id'], changed['active']))
+                            for d in cur['docs']:
+                                if d.get('id') in new_act: d['active'] = 1 if new_act[d['id']] else 0
+                            st.success(f"Đã lưu! Kích hoạt {n_on}, hủy kích hoạt {n_off} học sinh.")
+            elif search: st.warning(f"Không tìm thấy học sinh khớp '{search}'.")
             else: st.warning(f"Chưa có dữ liệu năm {year_sel}.")
 
         with t3:
@@ -307,15 +1389,69 @@ def view_admin(db):
             
             if st.button("🚨 THỰC HIỆN XÓA", type="primary"):
                 with st.spinner("Deleting..."):
-                    if d_hk1: delete_data_year(db, 'scores', year_sel, del_cls, 'HK1')
-                    if d_hk2: delete_data_year(db, 'scores', year_sel, del_cls, 'HK2')
-                    
-                    if d_thk1: delete_data_year(db, 'summary', year_sel, del_cls, 'HK1')
-                    if d_thk2: delete_data_year(db, 'summary', year_sel, del_cls, 'HK2') 
-                    if d_tcn:  delete_data_year(db, 'summary', year_sel, del_cls, 'CN')  
+                    bar = st.progress(0.0); msg = st.empty()
+                    def on_progress(coll, sem, done, total):
+                        msg.text(f"{coll} {sem or ''}: đã xóa {done}" + (f"/{total}" if total else ""))
+                        if total: bar.progress(min(1.0, done / total))
                     
-                    if d_all: delete_data_year(db, 'students', year_sel, del_cls)
-                    st.success("Đã xóa xong!")
+                    jobs = [('scores', 'HK1', d_hk1), ('scores', 'HK2', d_hk2),
+                            ('summary', 'HK1', d_thk1), ('summary', 'HK2', d_thk2), ('summary', 'CN', d_tcn),
+                            ('students', None, d_all)]
+                    done = {f"{coll} {sem or ''}".strip(): delete_data_year(db, coll, year_sel, del_cls, sem, progress=on_progress) for coll, sem, on in jobs if on}
+                    bar.progress(1.0)
+                    st.success("Đã xóa xong! " + ", ".join(f"{k}: {v}" for k, v in done.items()) + ". Nếu bị ngắt giữa chừng, bấm xóa lại để xóa nốt phần còn lại.")
+
+        with t4:
+            keys = ['reads', 'writes', 'deletes', 'queries']
+            last = st.session_state.get('_m_last', Counter()); sess = st.session_state.get('_m_session', Counter())
+            st.markdown("**Lượt chạy trước / cả phiên làm việc này:**")
+            for col, k in zip(st.columns(4), keys): col.metric(k, last[k], help=f"Cả phiên: {sess[k]}")
+            m = _metrics()
+            with m['lock']:
+                by_fn = pd.DataFrame({fn: {k: c[k] for k in keys + ['ms']} for fn, c in m['fn'].items()}).T
+                hist = pd.DataFrame({op: dict(c) for op, c in m['hist'].items()}).T
+            st.markdown("**Theo hàm (toàn tiến trình, từ lúc khởi động):**")
+            if not by_fn.empty: st.dataframe(by_fn.fillna(0).astype(int).sort_values('reads', ascending=False), use_container_width=True)
+            st.markdown("**Phân bố độ trễ theo loại thao tác (số lần gọi):**")
+            if not hist.empty:
+                order = [f"≤{b}ms" for b in LAT_BUCKETS] + [f">{LAT_BUCKETS[-1]}ms"]
+                st.dataframe(hist.reindex(columns=[c for c in order if c in hist.columns]).fillna(0).astype(int), use_container_width=True)
+            if st.button("Đặt lại số liệu"):
+                with m['lock']: m['fn'].clear(); m['hist'].clear()
+                st.session_state._m_session = Counter(); st.rerun()
+
+        with t5:
+            st.caption(f"Xuất điểm năm: **{year_sel}** (mỗi môn 1 sheet, cùng bố cục file nhập)")
+            c1, c2 = st.columns(2)
+            ex_cls = c1.selectbox("Lớp xuất:", ["Tất cả"] + [f"Lớp {i}" for i in range(6, 13)], key="ex_cls")
+            ex_sem = c2.selectbox("Học kỳ:", ["HK1", "HK2"], key="ex_sem")
+            if st.button("📤 TẠO FILE EXCEL", use_container_width=True):
+                with st.spinner("Đang đọc và ghi dữ liệu..."):
+                    with tempfile.TemporaryFile() as tmp:
+                        n = export_workbook(db, year_sel, ex_cls, ex_sem, tmp)
+                        tmp.seek(0); st.session_state.export_file = (f"Diem_{year_sel}_{ex_cls}_{ex_sem}.xlsx".replace(" ", "_"), tmp.read(), n)
+            if st.session_state.get('export_file'):
+                fname, data, n = st.session_state.export_file
+                st.success(f"Đã xuất {n} bản ghi.")
+                st.download_button("📥 TẢI FILE", data=data, file_name=fname, mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
+
+        with t6:
+            st.caption(f"Thống kê năm: **{year_sel}** (đọc từ số liệu tổng hợp sẵn, không quét bảng điểm)")
+            c1, c2 = st.columns(2)
+            stat_cls = c1.selectbox("Lớp:", [f"Lớp {i}" for i in range(6, 13)], key="stat_cls")
+            stat_sem = c2.selectbox("Học kỳ:", ["HK1", "HK2"], key="stat_sem")
+            sems = [stat_sem, 'CN'] if stat_sem == 'HK2' else [stat_sem]
+            docs = [d.to_dict() for d in db.collection('stats').where('year', '==', year_sel).where('cls', '==', stat_cls).where('sem', 'in', sems).stream()]
+            docs = [d for d in docs if d.get('agg', {}).get('n', 0) > 0]
+            if not docs: st.info("Chưa có số liệu thống kê cho lớp/kỳ này.")
+            else:
+                tb, cn, tk = stats_tables(docs)
+                if not tb.empty: st.markdown("**Điểm trung bình môn:**"); st.dataframe(tb, use_container_width=True)
+                if not cn.empty: st.markdown("**Cả năm:**"); st.dataframe(cn, use_container_width=True)
+                if not tk.empty: st.markdown("**Tổng kết (số học sinh):**"); st.dataframe(tk.sort_index(), use_container_width=True)
+            if st.button("🔄 Tính lại thống kê của lớp này", help="Dùng cho dữ liệu nạp trước khi có thống kê, hoặc khi thống kê bị lệch do lỗi ghi"):
+                with st.spinner("Đang quét dữ liệu..."): rebuild_stats(db, year_sel, stat_cls)
+                st.rerun()
 
         # --- MODULE GHÉP MÃ HS (CHỈ ADMIN THẤY) ---
         st.markdown("---")
@@ -324,77 +1460,59 @@ def view_admin(db):
         st.info("Khu vực ẩn dành riêng cho Admin: Upload file chứa mã HS và file điểm n môn để hệ thống tự động dò tìm 'Họ và tên' và điền 'Mã học sinh' vào tất cả các sheet. LƯU Ý: Để giữ nguyên 100% định dạng gốc, File Điểm bắt buộc phải là đuôi .xlsx")
         
         col_diem, col_ma = st.columns(2)
-        f_diem = col_diem.file_uploader("1. File Điểm (Bắt buộc .xlsx)", type=['xlsx'], key="f_diem_ghep")
+        f_diems = col_diem.file_uploader("1. File Điểm (Bắt buộc .xlsx, chọn được nhiều file)", type=['xlsx'], key="f_diem_ghep", accept_multiple_files=True)
         f_ma = col_ma.file_uploader("2. File Mã Học Sinh", type=['xlsx', 'xls', 'csv'], key="f_ma_ghep")
         
-        if f_diem and f_ma:
+        if f_diems and f_ma:
             if st.button("🚀 BÙNG NỔ HỢP NHẤT DỮ LIỆU", type="primary", use_container_width=True):
                 with st.spinner("Đang quét và hợp nhất dữ liệu trên tất cả các sheet... 🔥"):
                     try:
-                        def safe_norm(val):
-                            if pd.isna(val) or val is None: return ""
-                            return str(val).strip().lower()
-
-                        try: df_ma = pd.read_excel(f_ma)
-                        except: df_ma = pd.read_csv(f_ma)
-                        
-                        df_ma['Họ và tên'] = df_ma['Họ và tên'].apply(safe_norm)
-                        ma_dict = dict(zip(df_ma['Họ và tên'], df_ma['Mã học sinh']))
-                        
-                        file_diem_bytes = io.BytesIO(f_diem.getvalue())
-                        
-                        try:
-                            wb = load_workbook(file_diem_bytes)
-                        except Exception as zip_err:
-                            st.error("❌ Lỗi định dạng! File điểm của thầy có thể đang bị lỗi hoặc là file .xls cũ bị đổi đuôi. Xin hãy mở file điểm bằng Excel, chọn 'Save As' và lưu lại chuẩn với định dạng 'Excel Workbook (*.xlsx)' rồi upload lại nhé!")
-                            st.stop()
-                        
-                        for sheet_name in wb.sheetnames:
-                            ws = wb[sheet_name]
-                            
-                            header_row_idx = -1
-                            col_name_idx = -1
-                            col_id_idx = -1
-                            
-                            for row_idx, row in enumerate(ws.iter_rows(min_row=1, max_row=20, values_only=False), start=1):
-                                for col_idx, cell in enumerate(row, start=1):
-                                    val = safe_norm(cell.value)
-                                    if "họ và tên" in val or "họ tên" in val:
-                                        header_row_idx = row_idx
-                                        col_name_idx = col_idx
-                                    if "mã học sinh" in val:
-                                        col_id_idx = col_idx
-                                        
-                                if header_row_idx != -1 and col_id_idx != -1:
-                                    break 
-                            
-                            if header_row_idx != -1 and col_name_idx != -1 and col_id_idx != -1:
-                                for row_idx in range(header_row_idx + 1, ws.max_row + 1):
-                                    name_cell = ws.cell(row=row_idx, column=col_name_idx)
-                                    id_cell = ws.cell(row=row_idx, column=col_id_idx)
-                                    
-                                    temp_name = safe_norm(name_cell.value)
-                                    
-                                    if temp_name and temp_name in ma_dict:
-                                        id_cell.value = ma_dict[temp_name]
-                                            
-                        output = io.BytesIO()
-                        wb.save(output)
-                        processed_data = output.getvalue()
-                        
-                        st.success("Hợp nhất thành công! Tải file kết quả ngay bên dưới 🚀")
-                        st.download_button(
-                            label="📥 TẢI FILE KẾT QUẢ VỀ MÁY",
-                            data=processed_data,
-                            file_name="Diem_Da_Ghep_Ma_Giu_Nguyen_Dinh_Dang.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            use_container_width=True
-                        )
+                        ma_hash = file_hash(f_ma)
+                        index_key = ('merge_index', ma_hash)
+                        index = cache_get(index_key)
+                        if index is None:
+                            index = build_name_index(load_table_robust(f_ma)); cache_put(index_key, index)
+                        bar = st.progress(0.0); results = []
+                        for i, f_diem in enumerate(f_diems):
+                            # Cùng 2 file đã ghép trước đó -> lấy lại kết quả từ cache, không quét lại workbook
+                            merge_key = ('merge', file_hash(f_diem), ma_hash)
+                            res = cache_get(merge_key)
+                            if res is None:
+                                try: res = merge_ids(f_diem.getvalue(), *index)
+                                except zipfile.BadZipFile:
+                                    st.error(f"❌ Lỗi định dạng file {f_diem.name}! File điểm của thầy có thể đang bị lỗi hoặc là file .xls cũ bị đổi đuôi. Xin hãy mở file điểm bằng Excel, chọn 'Save As' và lưu lại chuẩn với định dạng 'Excel Workbook (*.xlsx)' rồi upload lại nhé!")
+                                    continue
+                                cache_put(merge_key, res)
+                            results.append((f_diem.name, *res)); bar.progress((i + 1) / len(f_diems))
+                        st.session_state.merge_result = (results, sorted(index[1]))
                     except Exception as e:
                         st.error(f"Có lỗi xảy ra trong quá trình xử lý: {e}")
+
+        if f_diems and f_ma and st.session_state.get('merge_result'):
+            results, dup_names = st.session_state.merge_result
+            if results:
+                st.success("Hợp nhất thành công! Tải file kết quả ngay bên dưới 🚀")
+                rows = [{'File': name, **{k: v for k, v in r.items() if k != 'missed'}} for name, _, rep in results for r in rep]
+                st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+                missed = [(name, r['Sheet'], t) for name, _, rep in results for r in rep for t in r['missed']]
+                if missed:
+                    with st.expander(f"Danh sách {len(missed)} học sinh chưa ghép được mã"):
+                        st.dataframe(pd.DataFrame(missed, columns=['File', 'Sheet', 'Họ và tên']), use_container_width=True, hide_index=True)
+                if dup_names: st.warning(f"{len(dup_names)} tên bị trùng trong file mã HS (cần điền tay): " + ", ".join(dup_names[:20]))
+                if len(results) == 1:
+                    name, data, _ = results[0]
+                    st.download_button(label="📥 TẢI FILE KẾT QUẢ VỀ MÁY", data=data, file_name=f"Da_Ghep_Ma_{name}",
+                                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
+                else:
+                    zbuf = io.BytesIO()
+                    with zipfile.ZipFile(zbuf, 'w', zipfile.ZIP_DEFLATED) as z:
+                        for name, data, _ in results: z.writestr(f"Da_Ghep_Ma_{name}", data)
+                    st.download_button(label=f"📥 TẢI {len(results)} FILE KẾT QUẢ (.zip)", data=zbuf.getvalue(), file_name="Diem_Da_Ghep_Ma.zip",
+                                       mime="application/zip", use_container_width=True)
         st.markdown('</div>', unsafe_allow_html=True)
 
 # --- 5. HỌC SINH UI ---
+@tracked_fn
 def view_student(db):
     st.markdown("""
     <style>
@@ -424,27 +1542,33 @@ def view_student(db):
     
     st.markdown('<div class="neon-title">ARENA XEM ĐIỂM 🔥<br><span style="font-size: 16px; color: #ffeb3b; text-shadow: none;">Trường PT DTNT THCS&THPT Tuy Đức</span></div>', unsafe_allow_html=True)
     
-    default_year = get_current_year_config(db)
-    current_fee = get_activation_fee(db) 
-    fee_k = current_fee // 1000 
-
     if 'show_activation' not in st.session_state:
         st.session_state.show_activation = False
 
     if 'user' not in st.session_state:
-        try: idx = YEAR_LIST.index(default_year)
-        except: idx = 0
-        year_login = st.selectbox("Năm học:", YEAR_LIST, index=idx)
+        # Vẽ form ngay với năm mặc định đang có trong cache (hoặc năm dự phòng); chưa đọc settings ở đây
+        # để lần khởi động nguội không phải chờ kết nối Firebase mới hiện ô nhập mã.
+        ss = st.session_state
+        if '_year_pending' in ss: ss.year_login = ss.pop('_year_pending')
+        if 'year_login' not in ss:
+            y = (peek_settings() or {}).get('default_year', '2024-2025')
+            ss.year_login = y if y in YEAR_LIST else YEAR_LIST[0]
+        year_login = st.selectbox("Năm học:", YEAR_LIST, key='year_login', on_change=lambda: ss.update(_year_picked=True))
         mid = st.text_input("Mã Học Sinh:", placeholder="VD: 2411...").strip()
         
         if st.button("TRA CỨU", type="primary", use_container_width=True):
             if not mid:
                 st.error("Vui lòng nhập Mã Học Sinh!")
+            elif not allow_lookup():
+                st.error("⏳ Bạn tra cứu quá nhanh, vui lòng thử lại sau ít giây.")
             else:
                 doc_key = f"{mid}_{year_login}"
-                doc = db.collection('students').document(doc_key).get()
+                m = mirror_for(db, year_login)
+                if m: doc = MirrorDoc(m.get('students', doc_key))
+                elif not maybe_student(db, mid, year_login): doc = MirrorDoc(None)
+                else: doc = db.collection('students').document(doc_key).get()
                 if not doc.exists: 
-                    st.error(f"❌ Không tìm thấy dữ liệu năm {year_login}! Liên hệ admin zalo: 0383477162 để đăng kí tài khoản. (Cân nhắc phí kích hoạt {fee_k}k/năm học)")
+                    st.error(f"❌ Không tìm thấy dữ liệu năm {year_login}! Liên hệ admin zalo: 0383477162 để đăng kí tài khoản. (Cân nhắc phí kích hoạt {get_activation_fee(db) // 1000}k/năm học)")
                     st.session_state.show_activation = False
                 elif doc.to_dict().get('active') != 1: 
                     st.warning(f"🔒 Tài khoản của bạn chưa được kích hoạt cho năm {year_login}.")
@@ -458,6 +1582,7 @@ def view_student(db):
 
         if st.session_state.get('show_activation'):
             temp_mid = st.session_state.get('temp_mid', '')
+            current_fee = get_activation_fee(db)
             fee_formatted = f"{current_fee:,}".replace(',', '.')
             
             st.markdown("""
@@ -485,6 +1610,12 @@ def view_student(db):
                 <p style="color: #ff9999; margin-top: 15px; font-size: 13px;"><i>* Sau khi CK thành công, vui lòng chụp màn hình gửi Zalo <b>0383477162</b> để Admin duyệt!</i></p>
             </div>
             """, unsafe_allow_html=True)
+
+        # Form đã hiện xong -> giờ mới đọc năm mặc định (có thể phải chờ kết nối); khác năm đang chọn thì cập nhật 1 lần
+        if not ss.get('_year_synced'):
+            ss._year_synced = True
+            y = get_current_year_config(db)
+            if y in YEAR_LIST and y != ss.year_login and not ss.get('_year_picked'): ss._year_pending = y; st.rerun()
             
     else:
         u = st.session_state.user
@@ -505,45 +1636,16 @@ def view_student(db):
         ky = st.radio("", ["Học kỳ 1", "Học kỳ 2 & Cả năm"], horizontal=True)
         sem = "HK1" if "1" in ky else "HK2"
         
-        docs = db.collection('scores').where('id', '==', u['id']).where('year', '==', year_view).where('sem', '==', sem).stream()
-        data = [d.to_dict() for d in docs]
+        table, tk_d, cn_d = student_result(db, u['id'], year_view, sem, u.get('cls'))
         
-        if data:
-            df = pd.DataFrame(data)
-            
-            def sort_priority(row):
-                s = str(row['sub']).lower()
-                if 'toán' in s: return 0
-                if 'văn' in s or 'ngữ văn' in s: return 1
-                if 'anh' in s or 'ngoại ngữ' in s: return 2
-                
-                eval_subs = ['thể chất', 'gdtc', 'quốc phòng', 'gdqp', 'trải nghiệm', 'hđtn', 'địa phương', 'nghệ thuật', 'âm nhạc', 'mỹ thuật']
-                if any(x in s for x in eval_subs): return 20 
-                return 10 
-            
-            df['priority'] = df.apply(sort_priority, axis=1)
-            df = df.sort_values(by=['priority', 'sub'])
-            
-            df['STT'] = range(1, len(df)+1)
-            
-            rn = {'sub': 'Môn', 'tx': 'TX', 'gk': 'GK', 'ck': 'CK', 'tb': 'TB', 'cn': 'CN'}
-            cols = ['STT', 'Môn', 'TX', 'GK', 'CK', 'TB']
-            if sem == 'HK2': cols.append('CN')
-            st.table(df.rename(columns=rn)[cols].set_index('STT'))
+        if table is not None: st.table(table)
         else: st.info("Chưa có điểm.")
         
-        doc_tk = f"{u['id']}_{year_view}_{sem}_sum"
-        tk = db.collection('summary').document(doc_tk).get()
-        tk_d = tk.to_dict() if tk.exists else {}
-        
         def card(l, v): return f'<div class="summary-item"><small style="color: #ff9999">{l}</small><div class="summary-val">{v if v else "-"}</div></div>'
         st.markdown(f"**TỔNG KẾT {sem}**")
         if tk_d: st.markdown(f"""<div class="summary-grid">{card('Học lực', tk_d.get('ht'))}{card('Hạnh kiểm', tk_d.get('rl'))}{card('Vắng', tk_d.get('v'))}{card('Danh hiệu', tk_d.get('dh'))}</div>""", unsafe_allow_html=True)
         
         if sem == 'HK2':
-            doc_cn = f"{u['id']}_{year_view}_CN_sum"
-            cn = db.collection('summary').document(doc_cn).get()
-            cn_d = cn.to_dict() if cn.exists else {}
             if cn_d:
                 st.markdown("---")
                 st.markdown("**CẢ NĂM**")
@@ -559,10 +1661,12 @@ def view_student(db):
 
 if __name__ == "__main__":
     if 'page' not in st.session_state: st.session_state.page = 'login'
+    meter = start_metering()
     try:
-        db = init_firebase()
+        db = Tracked(init_firebase(), meter)
         if st.session_state.page == 'admin': view_admin(db)
         else: view_student(db)
     except Exception as e: st.error("Lỗi hệ thống."); print(e)
+    finally: finish_metering(meter)
     
     st.markdown('<div class="copyright">Copyright©2026 - Lương Văn Giỏi - 0383477162</div>', unsafe_allow_html=True)
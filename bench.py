@@ -0,0 +1,117 @@
+"""Đo hiệu năng các luồng chính trên backend bộ nhớ (memstore), không cần Firebase.
+
+    python bench.py [--classes 7] [--students 40] [--subjects 15] [--save kq.json] [--baseline kq.json]
+
+Sinh workbook giả đúng bố cục file điểm (cột "Mã học sinh", tên ở cột -2, điểm ở các cột +1..+28),
+rồi đo: tốc độ đọc + dựng bản ghi, tải lên lần đầu, tải lại không đổi, xóa, tra cứu 1 học sinh.
+Số lượt đọc/ghi Firestore tương ứng được in kèm. --baseline báo lỗi (exit 1) nếu chậm hơn mức cho phép.
+"""
+import argparse
+import io
+import json
+import random
+import statistics
+import sys
+import time
+
+import pandas as pd
+
+import app
+from memstore import MemoryClient
+
+SUBJECTS = ["Toán", "Ngữ văn", "Tiếng Anh", "Vật lí", "Hóa học", "Sinh học", "Lịch sử", "Địa lí", "GDCD",
+            "Tin học", "Công nghệ", "GDTC", "GDQP", "HĐTN", "GD địa phương", "Âm nhạc", "Mỹ thuật"]
+
+def make_sheet(cls_no, n_students, rng):
+    # 3 dòng tiêu đề phía trên, "Mã học sinh" ở cột 3 -> tên ở cột 1, điểm ở cột 4..31
+    width = 3 + app.OFF_CN + 1
+    rows = [["SỞ GIÁO DỤC VÀ ĐÀO TẠO"] + [None] * (width - 1), [None] * width]
+    head = [None] * width; head[0] = "STT"; head[1] = "Họ và tên"; head[3] = "Mã học sinh"
+    rows.append(head)
+    for i in range(n_students):
+        r = [i + 1, f"Học sinh {cls_no}-{i}", None, f"24{cls_no:02d}{i:05d}"]
+        r += [round(rng.uniform(0, 10), 1) if rng.random() > 0.2 else None for _ in range(width - 4)]
+        rows.append(r)
+    return pd.DataFrame(rows)
+
+def make_workbook(cls_no, n_students, n_subjects, seed=0):
+    rng = random.Random(seed * 100 + cls_no)
+    bio = io.BytesIO()
+    with pd.ExcelWriter(bio) as w:
+        for sub in SUBJECTS[:n_subjects]: make_sheet(cls_no, n_students, rng).to_excel(w, sheet_name=sub, index=False, header=False)
+    return bio.getvalue()
+
+def timed(fn):
+    t = time.perf_counter(); out = fn(); return out, time.perf_counter() - t
+
+def run(args):
+    year = app.YEAR_LIST[0]
+    classes = list(range(6, 6 + args.classes))
+    books = {c: make_workbook(c, args.students, args.subjects) for c in classes}
+    n_rec = args.classes * args.students * args.subjects
+    res = {}
+
+    # 1. Đọc workbook + dựng bản ghi (không ghi DB)
+    _, dt = timed(lambda: [app.parse_score_workbook(app._read_as(b, 'xlsx'), year, 'HK1', f"Lớp {c}") for c, b in books.items()])
+    res['parse_rows_per_sec'] = n_rec / dt
+    # Cùng việc đó qua parse_score_sheets với tiến trình con (chỉ khi bật DIEM_PARSE_WORKERS và được cấp từ 2 nhân);
+    # tính cả thời gian khởi động tiến trình con vì pool được tạo lại cho mỗi file
+    if app.parse_pool_workers() > 1:
+        _, dt = timed(lambda: [app.parse_score_sheets(app._read_as(b, 'xlsx'), year, 'HK1', f"Lớp {c}", pool=True) for c, b in books.items()])
+        res['parse_pool_rows_per_sec'] = n_rec / dt
+
+    # 2. Tải lên lần đầu / 3. Tải lại file không đổi
+    db = MemoryClient()
+    app.cache_clear()
+    _, dt = timed(lambda: [app.upload_firebase(db, io.BytesIO(b), year, 'HK1', f"Lớp {c}", 'score') for c, b in books.items()])
+    res['upload_rows_per_sec'] = n_rec / dt; res['upload_writes'] = db.stats['writes']; res['upload_reads'] = db.stats['reads']
+    db.stats.clear()
+    _, dt = timed(lambda: [app.upload_firebase(db, io.BytesIO(b), year, 'HK1', f"Lớp {c}", 'score') for c, b in books.items()])
+    res['reupload_rows_per_sec'] = n_rec / dt; res['reupload_writes'] = db.stats['writes']
+
+    # 4. Tra cứu 1 học sinh (đường đi của màn hình HS)
+    ids = [d['id'] for d in db.data['students'].values()]
+    rng = random.Random(1); lat = []; db.stats.clear()
+    for mid in rng.choices(ids, k=args.lookups):
+        t = time.perf_counter(); app.load_student_result(db, mid, year, 'HK1'); lat.append((time.perf_counter() - t) * 1000)
+    lat.sort()
+    res['lookup_p50_ms'] = statistics.median(lat); res['lookup_p95_ms'] = lat[int(len(lat) * 0.95) - 1]
+    res['lookup_reads_each'] = db.stats['reads'] / args.lookups
+
+    # 5. Xóa toàn bộ điểm HK1 của năm
+    n_docs = len(db.data['scores'])
+    _, dt = timed(lambda: app.delete_data_year(db, 'scores', year, "Tất cả", 'HK1'))
+    res['delete_docs_per_sec'] = n_docs / dt
+    return res
+
+# Chỉ số "càng cao càng tốt"; các chỉ số còn lại (ms, số lượt đọc/ghi) là "càng thấp càng tốt"
+HIGHER_BETTER = ('parse_rows_per_sec', 'parse_pool_rows_per_sec', 'upload_rows_per_sec', 'reupload_rows_per_sec', 'delete_docs_per_sec')
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark nạp/xóa/tra cứu điểm trên backend bộ nhớ")
+    ap.add_argument('--classes', type=int, default=7)
+    ap.add_argument('--students', type=int, default=40)
+    ap.add_argument('--subjects', type=int, default=15)
+    ap.add_argument('--lookups', type=int, default=500)
+    ap.add_argument('--save', help="ghi kết quả ra file JSON")
+    ap.add_argument('--baseline', help="file JSON kết quả cũ để so sánh")
+    ap.add_argument('--tolerance', type=float, default=0.3, help="mức chậm hơn baseline cho phép (0.3 = 30%%)")
+    args = ap.parse_args(argv)
+
+    res = run(args)
+    base = json.load(open(args.baseline)) if args.baseline else {}
+    worse = []
+    for k, v in res.items():
+        line = f"{k:26s} {v:12.2f}"
+        if k in base:
+            ratio = v / base[k] if base[k] else 1.0
+            bad = ratio < 1 - args.tolerance if k in HIGHER_BETTER else ratio > 1 + args.tolerance
+            line += f"   (baseline {base[k]:.2f}{', CHẬM HƠN' if bad else ''})"
+            if bad: worse.append(k)
+        print(line)
+    if args.save: json.dump(res, open(args.save, 'w'), indent=2)
+    if worse: print("Suy giảm hiệu năng: " + ", ".join(worse)); return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
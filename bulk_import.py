@@ -0,0 +1,88 @@
+"""Nạp hàng loạt file điểm của cả trường từ dòng lệnh (không qua giao diện Streamlit).
+
+    python bulk_import.py <thư mục> --year 2025-2026 [--workers 4] [--dry-run]
+
+Tên file phải chứa lớp và kỳ, VD: "Lop6_HK1.xlsx", "Lớp 10 - HK2.xls", "Lop12_TK.xlsx".
+Các file được đọc song song trên nhiều tiến trình, dữ liệu ghi chung qua 1 ParallelWriter.
+"""
+import argparse
+import io
+import os
+import re
+import sys
+import unicodedata
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import app
+
+EXTS = ('.xlsx', '.xls', '.csv', '.html', '.htm')
+
+def classify(fname):
+    # Tên file -> (lớp, kỳ, loại) hoặc None nếu không nhận ra
+    n = unicodedata.normalize('NFC', os.path.splitext(fname)[0]).lower()
+    m = re.search(r'l[oơớ]p\s*[_\-. ]*(\d{1,2})', n) or re.search(r'(?<!\d)(1[0-2]|[6-9])(?!\d)', n)
+    if not m or not 6 <= int(m.group(1)) <= 12: return None
+    cls = f"Lớp {int(m.group(1))}"
+    if re.search(r'(?<![a-z])tk(?![a-z])|tong\s*ket|tổng\s*kết', n): return cls, 'HK1', 'summary'
+    k = re.search(r'hk\s*[_\-]?\s*([12])', n)
+    if not k: return None
+    return cls, f"HK{k.group(1)}", 'score'
+
+def parse_file(path, year, sem, cls, kind):
+    # Chạy trong tiến trình con: chỉ đọc + dựng bản ghi, không đụng Firestore
+    with open(path, 'rb') as f: bio = io.BytesIO(f.read())
+    if kind == 'score':
+        data = app.load_excel_robust(bio)
+        if not data: raise ValueError("không đọc được file")
+        return app.parse_score_workbook(data, year, sem, cls)
+    return app.parse_summary_table(app.load_table_robust(bio), year, sem, cls)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Nạp hàng loạt file điểm vào Firestore")
+    ap.add_argument('folder')
+    ap.add_argument('--year', required=True, choices=app.YEAR_LIST)
+    ap.add_argument('--workers', type=int, default=os.cpu_count())
+    ap.add_argument('--dry-run', action='store_true', help="chỉ đọc file và báo số bản ghi, không ghi dữ liệu")
+    args = ap.parse_args(argv)
+
+    jobs = []
+    for fname in sorted(os.listdir(args.folder)):
+        if not fname.lower().endswith(EXTS): continue
+        info = classify(fname)
+        if info is None: print(f"[BỎ QUA] {fname}: không nhận ra lớp/kỳ trong tên file"); continue
+        jobs.append((fname, *info))
+    if not jobs: print("Không có file nào để nạp."); return 1
+
+    db = None if args.dry_run else app.init_firebase()
+    w = None if args.dry_run else app.ParallelWriter(db)
+    totals = Counter(); failed = 0; changed = set()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futs = {pool.submit(parse_file, os.path.join(args.folder, fname), args.year, sem, cls, kind): (fname, cls, sem, kind) for fname, cls, sem, kind in jobs}
+        # Ghi ngay file nào đọc xong trước, trong lúc các file khác vẫn đang được đọc
+        for fut in as_completed(futs):
+            fname, cls, sem, kind = futs[fut]
+            label = f"{fname} ({cls}, {'Tổng kết' if kind == 'summary' else sem})"
+            try: parsed = fut.result()
+            except Exception as e: print(f"[LỖI] {label}: {e}"); failed += 1; continue
+            n = len(parsed[1] if kind == 'score' else parsed)
+            if args.dry_run:
+                totals['records'] += n; print(f"[DRY-RUN] {label}: {n} bản ghi"); continue
+            if kind == 'score': stats = app.write_scores(db, w, args.year, sem, cls, *parsed)
+            else: stats = app.write_summary(db, w, args.year, cls, parsed)
+            totals += stats
+            if stats['inserted'] or stats['updated']: changed.add(cls)
+            print(f"[OK] {label}: mới {stats['inserted']}, cập nhật {stats['updated']}, không đổi {stats['unchanged']}")
+
+    if args.dry_run: print(f"Tổng: {totals['records']} bản ghi từ {len(jobs) - failed} file.")
+    else:
+        w.close()
+        if totals['new_students']: app.students_changed(db, args.year)
+        for cls in sorted(changed): app.data_changed(db, args.year, cls)
+        print(app.format_upload_stats(totals))
+        for path, err in w.errors[:20]: print(f"[LỖI GHI] {path}: {err}")
+        if w.errors: print(f"Tổng cộng {len(w.errors)} thao tác ghi thất bại."); failed += 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
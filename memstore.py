@@ -0,0 +1,173 @@
+"""Backend lưu trữ trong bộ nhớ, cùng giao diện với phần Firestore client mà app.py dùng.
+
+Dùng để chạy thử / đo hiệu năng (bench.py) mà không cần project Firebase thật:
+    DIEM_BACKEND=memory streamlit run app.py
+Chỉ hỗ trợ các thao tác app.py cần: document get/set/update/delete, where (==, >=, <=, in),
+order_by, select, limit, start_after, stream, count, batch, get_all, on_snapshot.
+Giá trị đặc biệt: chỉ hỗ trợ firestore.Increment (cộng vào giá trị số hiện có, kể cả trong map lồng nhau).
+"""
+import copy
+import threading
+from collections import defaultdict
+
+def _is_increment(v): return type(v).__name__ == 'Increment' and hasattr(v, 'value')
+
+def _value(old, v, merge):
+    # Giá trị mới của 1 field: Increment cộng vào số cũ, map được trộn (merge) hoặc chép mới.
+    # Như Firestore: map rỗng trong set(merge=True) thay cả field bằng {} chứ không phải "không đổi gì".
+    if _is_increment(v): return (old if isinstance(old, (int, float)) and not isinstance(old, bool) else 0) + v.value
+    if isinstance(v, dict): return _apply(old if merge and v and isinstance(old, dict) else {}, v, True)
+    return copy.deepcopy(v)
+
+def _apply(old, new, merge):
+    if not merge: old = {}
+    out = dict(old)
+    for k, v in new.items(): out[k] = _value(old.get(k), v, merge)
+    return out
+
+class Snapshot:
+    def __init__(self, ref, data, fields=None):
+        self.reference, self.id, self.exists = ref, ref.id, data is not None
+        self._data = data
+        self._fields = fields
+
+    def to_dict(self):
+        if self._data is None: return None
+        if self._fields is None: return copy.deepcopy(self._data)
+        return {f: copy.deepcopy(self._data[f]) for f in self._fields if f != '__name__' and f in self._data}
+
+    def get(self, field): return (self._data or {}).get(field)
+
+class DocumentRef:
+    def __init__(self, client, coll, doc_id):
+        self._client, self._coll, self.id = client, coll, doc_id
+        self.path = f"{coll}/{doc_id}"
+
+    def get(self, field_paths=None):
+        with self._client.lock:
+            data = self._client.data[self._coll].get(self.id)
+            self._client.stats['reads'] += 1
+        return Snapshot(self, data, field_paths)
+
+    def set(self, data, merge=False): self._client._write(self, 'set', data, merge)
+    def update(self, data): self._client._write(self, 'update', data, True)
+    def delete(self): self._client._write(self, 'delete', None, False)
+
+class Query:
+    def __init__(self, client, coll, filters=(), orders=(), fields=None, limit=None, cursor=None):
+        self._client, self._coll = client, coll
+        self._filters, self._orders, self._fields, self._limit, self._cursor = list(filters), list(orders), fields, limit, cursor
+
+    def _copy(self, **kw):
+        q = Query(self._client, self._coll, self._filters, self._orders, self._fields, self._limit, self._cursor)
+        for k, v in kw.items(): setattr(q, '_' + k, v)
+        return q
+
+    def where(self, field, op, value): return self._copy(filters=self._filters + [(field, op, value)])
+    def order_by(self, field, direction='ASCENDING'): return self._copy(orders=self._orders + [field])
+    def select(self, fields): return self._copy(fields=list(fields))
+    def limit(self, n): return self._copy(limit=n)
+    def start_after(self, cursor): return self._copy(cursor=cursor)
+    def document(self, doc_id): return DocumentRef(self._client, self._coll, doc_id)
+    def count(self): return _Count(self)
+
+    def _match(self, data):
+        for field, op, value in self._filters:
+            if field not in data: return False
+            v = data[field]
+            if op == '==' and v != value: return False
+            if op == '>=' and not v >= value: return False
+            if op == '<=' and not v <= value: return False
+            if op == 'in' and v not in value: return False
+        return all(f in data for f in self._orders)
+
+    def _items(self):
+        with self._client.lock: items = [(k, v) for k, v in self._client.data[self._coll].items() if self._match(v)]
+        key = lambda kv: tuple(kv[1][f] for f in self._orders) + (kv[0],)
+        items.sort(key=key)
+        if self._cursor is not None:
+            if isinstance(self._cursor, Snapshot): after = key((self._cursor.id, self._cursor._data))
+            else: after = tuple(self._cursor[f] for f in self._orders)
+            items = [kv for kv in items if key(kv)[:len(after)] > after]
+        return items[:self._limit] if self._limit is not None else items
+
+    def stream(self):
+        items = self._items()
+        with self._client.lock: self._client.stats['queries'] += 1; self._client.stats['reads'] += max(1, len(items))
+        for k, v in items: yield Snapshot(DocumentRef(self._client, self._coll, k), v, self._fields)
+
+    def get(self): return list(self.stream())
+
+    def on_snapshot(self, callback): return self._client._listen(self, callback)
+
+class _Count:
+    def __init__(self, q): self._q = q
+    def get(self):
+        class R: pass
+        r = R(); r.value = len(self._q._items())
+        return [[r]]
+
+class _ChangeType:
+    def __init__(self, name): self.name = name
+
+class DocumentChange:
+    def __init__(self, kind, snap): self.type, self.document = _ChangeType(kind), snap
+
+class Watch:
+    def __init__(self, client, entry): self._client, self._entry = client, entry
+    def unsubscribe(self):
+        with self._client.lock:
+            if self._entry in self._client.listeners: self._client.listeners.remove(self._entry)
+
+class Batch:
+    def __init__(self, client): self._client, self._ops = client, []
+    def set(self, ref, data, merge=False): self._ops.append((ref, 'set', data, merge))
+    def update(self, ref, data): self._ops.append((ref, 'update', data, True))
+    def delete(self, ref): self._ops.append((ref, 'delete', None, False))
+    def commit(self):
+        # Kiểm tra trước rồi mới ghi -> cả batch thành công hoặc không ghi gì (như Firestore)
+        with self._client.lock:
+            for ref, kind, _, _ in self._ops:
+                if kind == 'update' and ref.id not in self._client.data[ref._coll]: raise KeyError(f"No document to update: {ref.path}")
+            for op in self._ops: self._client._write(*op)
+        return self._ops
+
+class MemoryClient:
+    def __init__(self):
+        self.data = defaultdict(dict)  # {collection: {doc_id: dict}}
+        self.lock = threading.RLock()
+        self.stats = defaultdict(int)
+        self.listeners = []  # [(query, callback)]
+
+    def collection(self, name): return Query(self, name)
+    def batch(self): return Batch(self)
+
+    def get_all(self, refs, field_paths=None):
+        for ref in refs: yield ref.get(field_paths)
+
+    def _write(self, ref, kind, data, merge):
+        with self.lock:
+            docs = self.data[ref._coll]
+            old = docs.get(ref.id)
+            if kind == 'delete': docs.pop(ref.id, None)
+            else:
+                if kind == 'update':
+                    # update() thay nguyên giá trị từng field cấp 1 (không trộn sâu)
+                    if ref.id not in docs: raise KeyError(f"No document to update: {ref.path}")
+                    docs[ref.id] = {**docs[ref.id], **{k: _value(docs[ref.id].get(k), v, False) for k, v in data.items()}}
+                else: docs[ref.id] = _apply(docs.get(ref.id, {}), data, merge)
+            self.stats['deletes' if kind == 'delete' else 'writes'] += 1
+            new = docs.get(ref.id)
+            for q, cb in self.listeners:
+                if q._coll != ref._coll: continue
+                was, now = old is not None and q._match(old), new is not None and q._match(new)
+                if now: cb(None, [DocumentChange('ADDED' if not was else 'MODIFIED', Snapshot(ref, new))], None)
+                elif was: cb(None, [DocumentChange('REMOVED', Snapshot(ref, old))], None)
+
+    def _listen(self, query, callback):
+        # Gọi callback ngay với toàn bộ kết quả hiện tại, sau đó với từng thay đổi (đồng bộ, trong thread ghi)
+        with self.lock:
+            snaps = query.get()
+            callback(snaps, [DocumentChange('ADDED', d) for d in snaps], None)
+            entry = (query, callback); self.listeners.append(entry)
+        return Watch(self, entry)
@@ -0,0 +1,33 @@
+import os
+import sys
+
+os.environ.setdefault('DIEM_BACKEND', 'memory')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture
+def db():
+    # Mỗi test 1 kho dữ liệu trống; cache file upload dùng chung cả tiến trình nên xóa luôn
+    import app
+    from memstore import MemoryClient
+    app.cache_clear()
+    return MemoryClient()
+
+@pytest.fixture
+def flaky_db(db, monkeypatch):
+    # db.failures: kết quả lần lượt của các lần commit batch: None = thành công, (lỗi, batch đã được ghi trước khi báo lỗi?)
+    import app
+    from memstore import Batch
+    class FlakyBatch(Batch):
+        def commit(self):
+            if not db.failures or db.failures[0] is None:
+                if db.failures: db.failures.pop(0)
+                return super().commit()
+            err, applied = db.failures.pop(0)
+            if applied: super().commit()
+            raise err
+    db.failures = []
+    db.batch = lambda: FlakyBatch(db)
+    monkeypatch.setattr(app.time, 'sleep', lambda s: None)
+    return db
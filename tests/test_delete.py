@@ -0,0 +1,31 @@
+# delete_data_year: xóa đúng phạm vi, báo tiến độ, chạy lại sau khi bị ngắt thì xóa nốt phần còn sót
+from google.api_core import exceptions as gexc
+
+import app
+
+Y = app.YEAR_LIST[0]
+
+def seed_scores(db, n, cls="Lớp 6", sem='HK1', year=Y):
+    for i in range(n):
+        db.collection('scores').document(f"{cls}_{sem}_{year}_{i}").set({'id': f"{i:09d}", 'year': year, 'sem': sem, 'cls': cls, 'sub': 'Toán', 'tb': '7'})
+
+def test_deletes_only_the_scope(db):
+    seed_scores(db, 30); seed_scores(db, 5, cls="Lớp 7"); seed_scores(db, 5, sem='HK2'); seed_scores(db, 5, year=app.YEAR_LIST[1])
+    assert app.delete_data_year(db, 'scores', Y, "Lớp 6", 'HK1') == 30
+    left = db.data['scores'].values()
+    assert len(left) == 15 and not any(d['cls'] == "Lớp 6" and d['sem'] == 'HK1' and d['year'] == Y for d in left)
+
+def test_reports_progress(db, monkeypatch):
+    monkeypatch.setattr(app, 'DELETE_PAGE', 7)
+    seed_scores(db, 30); calls = []
+    app.delete_data_year(db, 'scores', Y, "Tất cả", 'HK1', progress=lambda coll, sem, done, total: calls.append((done, total)))
+    assert calls[-1] == (30, 30) and len(calls) >= 5 and all(t == 30 for _, t in calls)
+
+def test_rerun_deletes_what_is_left(flaky_db, monkeypatch):
+    monkeypatch.setattr(app, 'DELETE_PAGE', 100)
+    seed_scores(flaky_db, 1000)
+    flaky_db.failures = [(gexc.PermissionDenied("x"), False)]  # 1 batch (400 doc) lỗi, các batch khác vẫn xóa
+    assert app.delete_data_year(flaky_db, 'scores', Y, "Lớp 6", 'HK1') == 600
+    assert len(flaky_db.data['scores']) == 400
+    assert app.delete_data_year(flaky_db, 'scores', Y, "Lớp 6", 'HK1') == 400
+    assert not flaky_db.data['scores']
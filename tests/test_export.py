@@ -0,0 +1,28 @@
+# XUẤT EXCEL: file xuất ra đúng bố cục file nhập -> nạp lại không đổi gì
+import io
+
+import pandas as pd
+
+import app
+import bench
+
+Y, CLS, MA = app.YEAR_LIST[0], "Lớp 6", "240600000"
+
+def test_export_reupload_is_unchanged(db):
+    app.upload_firebase(db, io.BytesIO(bench.make_workbook(6, 5, 3)), Y, 'HK1', CLS, 'score')
+    db.data['summary']['x'] = {'id': MA, 'year': Y, 'sem': 'HK1', 'cls': CLS, 'ht': 'Tốt', 'rl': 'Tốt', 'v': '0', 'dh': '', 'kq': ''}
+    students, subs = {k: dict(v) for k, v in db.data['students'].items()}, {v['sub'] for v in db.data['scores'].values()}
+    bio = io.BytesIO(); app.export_workbook(db, Y, CLS, 'HK1', bio)
+    app.cache_clear()
+    stats = app.upload_firebase(db, io.BytesIO(bio.getvalue()), Y, 'HK1', CLS, 'score')
+    assert stats['unchanged'] == len(db.data['scores']) and not stats['inserted'] and not stats['updated']
+    assert db.data['students'] == students and {v['sub'] for v in db.data['scores'].values()} == subs
+
+def test_export_sheets_and_count(db):
+    app.upload_firebase(db, io.BytesIO(bench.make_workbook(6, 5, 3)), Y, 'HK2', CLS, 'score')
+    app.upload_firebase(db, io.BytesIO(bench.make_workbook(7, 4, 2)), Y, 'HK2', "Lớp 7", 'score')
+    bio = io.BytesIO()
+    assert app.export_workbook(db, Y, CLS, 'HK2', bio) == 15
+    sheets = pd.read_excel(io.BytesIO(bio.getvalue()), sheet_name=None, header=None)
+    assert len(sheets) == 4 and 'Tổng kết' in sheets
+    assert app.export_workbook(db, Y, "Tất cả", 'HK2', io.BytesIO()) == 23
@@ -0,0 +1,29 @@
+# Nạp lại file: bản ghi có dấu vân tay (fp) không đổi thì bỏ qua, chỉ ghi bản ghi mới / có thay đổi
+import io
+
+import app
+import bench
+
+Y, CLS = app.YEAR_LIST[0], "Lớp 6"
+
+def upload(db, raw): return app.upload_firebase(db, io.BytesIO(raw), Y, 'HK1', CLS, 'score')
+
+def test_reupload_same_file_writes_nothing(db):
+    raw = bench.make_workbook(6, 10, 3)
+    first = upload(db, raw)
+    app.cache_clear(); db.stats.clear()
+    again = upload(db, raw)
+    assert again['unchanged'] == first['inserted'] > 0 and not again['inserted'] and not again['updated']
+    assert db.stats['writes'] == 0
+
+def test_only_changed_records_are_written(db):
+    upload(db, bench.make_workbook(6, 10, 3))
+    doc_id = next(iter(db.data['scores']))
+    db.data['scores'][doc_id] = {**db.data['scores'][doc_id], 'fp': 'cu'}
+    app.cache_clear()
+    stats = upload(db, bench.make_workbook(6, 10, 3))
+    assert stats['updated'] == 1 and stats['unchanged'] == len(db.data['scores']) - 1
+    assert db.data['scores'][doc_id]['fp'] == app.record_fp({k: v for k, v in db.data['scores'][doc_id].items() if k != 'fp'})
+
+def test_fp_ignores_key_order():
+    assert app.record_fp({'a': 1, 'b': '2'}) == app.record_fp({'b': '2', 'a': 1}) != app.record_fp({'a': 1, 'b': '3'})
@@ -0,0 +1,69 @@
+# Job nạp nền: checkpoint từng bước, hủy / tiếp tục, lỗi đã khắc phục không còn sau khi khởi động lại
+import io
+import os
+import time
+
+from google.api_core import exceptions as gexc
+
+import app
+import bench
+
+Y, CLS = app.YEAR_LIST[0], "Lớp 6"
+
+def make_job(raw, job_id='job_test'):
+    job = app.UploadJob(job_id, 'diem.xlsx', Y, 'HK1', CLS, 'score')
+    os.makedirs(app.JOB_DIR, exist_ok=True)
+    with open(job.path, 'wb') as f: f.write(raw)
+    return job
+
+def test_job_writes_everything_and_reads_students_once(db):
+    raw = bench.make_workbook(6, 20, 4)
+    job = make_job(raw); job.run(db)
+    assert job.status == 'done' and not job.errors and job.done[0] == '__students__' and job.done[-1] == '__reports__'
+    assert len(db.data['scores']) == 80 and len(db.data['students']) == 20 and len(db.data['reports']) == 20
+    assert job.meter.run['reads'] == db.stats['reads'] > 0  # mọi lượt đọc của job đều được đếm
+    student_reads = []
+    get_all = db.get_all
+    db.get_all = lambda refs, field_paths=None: student_reads.extend(r for r in refs if r._coll == 'students') or get_all(refs, field_paths)
+    app.cache_clear(); make_job(raw, 'job_test2').run(db)
+    assert len(student_reads) == 20
+
+def test_cancel_then_resume_skips_finished_steps(db, monkeypatch):
+    job = make_job(bench.make_workbook(6, 10, 4)); calls = []
+    write_scores = app.write_scores
+    def cancel_after_first(*a, **k):
+        calls.append(a[6])
+        if len(calls) == 1: job.cancel_evt.set()  # bấm Hủy trong lúc ghi sheet đầu tiên
+        return write_scores(*a, **k)
+    monkeypatch.setattr(app, 'write_scores', cancel_after_first)
+    job.run(db)
+    assert job.status == 'cancelled' and len(calls) == 1 and len(db.data['scores']) == 10 and not db.data['reports']
+    job.cancel_evt.clear(); job.run(db)
+    assert job.status == 'done' and len(calls) == 4 and len(db.data['scores']) == 40 and len(db.data['reports']) == 10
+
+def test_resume_after_restart_clears_fixed_errors(flaky_db):
+    raw = bench.make_workbook(6, 10, 2)
+    flaky_db.failures = [(gexc.PermissionDenied("x"), False)]  # bước đầu (__students__) lỗi
+    job = make_job(raw); job.run(flaky_db)
+    assert job.status == 'failed' and list(job.errors) == ['__students__']
+    # Khởi động lại tiến trình: job mới nạp checkpoint từ Firestore
+    job2 = make_job(raw); job2.load(flaky_db.data['upload_jobs'][job.id]); job2.run(flaky_db)
+    assert job2.status == 'done' and not job2.errors and len(flaky_db.data['reports']) == 10
+    assert flaky_db.data['upload_jobs'][job.id]['errors'] == {}
+    job3 = make_job(raw); job3.load(flaky_db.data['upload_jobs'][job.id])
+    assert not job3.errors
+
+def test_submit_runs_in_background(db):
+    app._job_queue()['jobs'].clear()
+    job = app.submit_upload(db, io.BytesIO(bench.make_workbook(7, 5, 2)), Y, 'HK1', "Lớp 7", 'score')
+    for _ in range(200):
+        if job.status not in ('queued', 'running'): break
+        time.sleep(0.05)
+    assert job.status == 'done' and len(db.data['scores']) == 10 and not os.path.exists(job.path)
+    assert db.data['upload_jobs'][job.id]['status'] == 'done'
+
+def test_checkpoint_drops_removed_errors(db):
+    job = make_job(b'')
+    job.errors = {'Toán': 'lỗi', 'Ngữ văn': 'lỗi'}; job.checkpoint(db)
+    job.errors.pop('Toán'); job.checkpoint(db)
+    assert db.data['upload_jobs'][job.id]['errors'] == {'Ngữ văn': 'lỗi'}
@@ -0,0 +1,63 @@
+# TRA CỨU: bộ lọc mã không tồn tại (không tốn lượt đọc) và giới hạn tốc độ theo session / IP
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+Y = app.YEAR_LIST[0]
+
+@pytest.fixture
+def fake_st(monkeypatch):
+    # Thay st: mỗi test 1 session, header do test đặt; đồng hồ do test điều khiển
+    s = SimpleNamespace(session_state={}, context=SimpleNamespace(headers={}))
+    monkeypatch.setattr(app, 'st', s)
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(app.time, 'time', lambda: clock.now)
+    app._ip_buckets()['buckets'].clear()
+    s.clock = clock
+    return s
+
+def add_student(db, mid, year=Y): db.collection('students').document(f"{mid}_{year}").set({'id': mid, 'year': year, 'cls': "Lớp 6", 'name': 'A', 'active': 0})
+
+def test_unknown_id_needs_no_read(db):
+    add_student(db, '2406000001'); add_student(db, '2406000009', year=app.YEAR_LIST[1])
+    app.students_changed(db, Y)
+    assert app.maybe_student(db, '2406000001', Y)
+    db.stats.clear()
+    assert not app.maybe_student(db, '2406000002', Y) and not app.maybe_student(db, '2406000009', Y)
+    assert db.stats['reads'] == 0
+
+def test_filter_rebuilt_after_students_change(db):
+    add_student(db, '2406000001'); app.students_changed(db, Y)
+    assert not app.maybe_student(db, '2406000002', Y)
+    add_student(db, '2406000002'); app.students_changed(db, Y)
+    assert app.maybe_student(db, '2406000002', Y)
+
+def test_session_bucket(fake_st):
+    cap, rate = app.LOOKUP_LIMITS['session']
+    assert all(app.allow_lookup() for _ in range(int(cap))) and not app.allow_lookup()
+    fake_st.clock.now += 1 / rate
+    assert app.allow_lookup() and not app.allow_lookup()
+
+def test_client_ip_uses_last_forwarded_address(fake_st):
+    assert app.client_ip() is None
+    fake_st.context.headers = {'X-Forwarded-For': '6.6.6.6, 1.2.3.4'}
+    assert app.client_ip() == '1.2.3.4'
+
+def test_school_behind_one_ip_is_not_blocked(fake_st):
+    # 300 HS cùng 1 NAT, mỗi HS 1 session tra cứu 1 lần lúc công bố điểm
+    fake_st.context.headers = {'X-Forwarded-For': '1.2.3.4'}
+    ok = 0
+    for _ in range(300): fake_st.session_state = {}; ok += app.allow_lookup()
+    assert ok == 300
+
+def test_ip_limit_from_env(fake_st, monkeypatch):
+    fake_st.context.headers = {'X-Forwarded-For': '1.2.3.4'}
+    monkeypatch.setenv('DIEM_LOOKUP_IP_LIMIT', '5,1')
+    assert app.ip_limit() == (5.0, 1.0)
+    ok = 0
+    for _ in range(20): fake_st.session_state = {}; ok += app.allow_lookup()
+    assert ok == 5
+    monkeypatch.setenv('DIEM_LOOKUP_IP_LIMIT', '0')
+    assert app.ip_limit() is None and app.allow_lookup()
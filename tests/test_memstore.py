@@ -0,0 +1,41 @@
+# memstore phải theo đúng ngữ nghĩa ghi của Firestore mà app.py dựa vào
+import pytest
+from google.cloud.firestore_v1.transforms import Increment
+
+def test_merge_set_merges_nested_maps(db):
+    ref = db.collection('c').document('d')
+    ref.set({'a': 1, 'm': {'x': 1, 'y': 2}})
+    ref.set({'m': {'y': 3, 'z': 4}}, merge=True)
+    assert ref.get().to_dict() == {'a': 1, 'm': {'x': 1, 'y': 3, 'z': 4}}
+
+def test_merge_set_empty_map_replaces_field(db):
+    ref = db.collection('c').document('d')
+    ref.set({'a': 1, 'm': {'x': 1}})
+    ref.set({'m': {}}, merge=True)
+    assert ref.get().to_dict() == {'a': 1, 'm': {}}
+
+def test_set_without_merge_replaces_doc(db):
+    ref = db.collection('c').document('d')
+    ref.set({'a': 1, 'm': {'x': 1}})
+    ref.set({'m': {'y': 2}})
+    assert ref.get().to_dict() == {'m': {'y': 2}}
+
+def test_update_replaces_top_level_field(db):
+    ref = db.collection('c').document('d')
+    ref.set({'a': 1, 'm': {'x': 1}})
+    ref.update({'m': {'y': 2}})
+    assert ref.get().to_dict() == {'a': 1, 'm': {'y': 2}}
+    with pytest.raises(KeyError): db.collection('c').document('khong_co').update({'a': 1})
+
+def test_increment_in_nested_map(db):
+    ref = db.collection('c').document('d')
+    ref.set({'agg': {'n': Increment(3), 's': Increment(1.5)}}, merge=True)
+    ref.set({'agg': {'n': Increment(-1)}}, merge=True)
+    assert ref.get().to_dict() == {'agg': {'n': 2, 's': 1.5}}
+
+def test_batch_is_all_or_nothing(db):
+    b = db.batch()
+    b.set(db.collection('c').document('a'), {'v': 1})
+    b.update(db.collection('c').document('khong_co'), {'v': 1})
+    with pytest.raises(KeyError): b.commit()
+    assert not db.data['c']
@@ -0,0 +1,43 @@
+# Ghép mã HS: so khớp tên đã chuẩn hóa, tên trùng không ghép, báo cáo từng sheet, giữ nguyên định dạng file
+import io
+import unicodedata
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font
+
+import app
+
+def id_file(rows):
+    return pd.DataFrame(rows, columns=['Họ và tên', 'Mã học sinh'])
+
+def test_name_index_normalizes_and_splits_duplicates():
+    nfd = unicodedata.normalize('NFD', "Nguyễn Văn An")
+    index, dups = app.build_name_index(id_file([[nfd, 2406000001], ["  trần   thị BÌNH ", "2406000002"], ["Lê C", "1"], ["Lê C", "2"], ["Lê C", "1"]]))
+    assert index == {"nguyễn văn an": "2406000001", "trần thị bình": "2406000002"}
+    assert dups == {"lê c": ["1", "2"]}
+
+def test_name_index_finds_header_row():
+    df = pd.DataFrame([["DANH SÁCH", None], ["Họ và tên", "Mã học sinh"], ["A", "11"]])
+    assert app.build_name_index(df) == ({"a": "11"}, {})
+    with pytest.raises(ValueError): app.build_name_index(pd.DataFrame([["x", "y"]]))
+
+def score_workbook():
+    wb = Workbook(); ws = wb.active; ws.title = "Toán"
+    ws.append(["BẢNG ĐIỂM"]); ws.append(["STT", "Họ và tên", "Mã học sinh", "TX1"])
+    for i, name in enumerate(["Nguyễn Văn An", "Lê C", "Không Có", None, "trần thị bình"], start=1): ws.append([i, name, None, 8])
+    ws["B3"].font = Font(bold=True)
+    wb.create_sheet("Bìa").append(["Trường THCS"])
+    out = io.BytesIO(); wb.save(out); return out.getvalue()
+
+def test_merge_writes_only_matched_cells_and_reports():
+    index, dups = app.build_name_index(id_file([["Nguyễn Văn An", "2406000001"], ["Trần Thị Bình", "2406000002"], ["Lê C", "1"], ["Lê C", "2"]]))
+    raw, report = app.merge_ids(score_workbook(), index, dups)
+    ws = load_workbook(io.BytesIO(raw))["Toán"]
+    assert [ws.cell(row=r, column=3).value for r in range(3, 8)] == ["2406000001", None, None, None, "2406000002"]
+    assert ws["B3"].font.bold and ws["D3"].value == 8
+    toan, bia = report
+    assert (toan['Sheet'], toan['Khớp'], toan['Không khớp'], toan['Trùng tên']) == ("Toán", 2, 1, 1)
+    assert toan['missed'] == ["Không Có", "Lê C (trùng tên)"]
+    assert bia['Khớp'] == 0 and bia['Ghi chú']
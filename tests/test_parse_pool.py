@@ -0,0 +1,49 @@
+# Đọc sheet song song: tắt mặc định, theo hạn mức CPU của cgroup, pool đóng ngay sau mỗi file
+import io
+import multiprocessing
+
+import pytest
+
+import app
+import bench
+
+def fake_files(monkeypatch, files, cores=8):
+    monkeypatch.setattr(app.os, 'sched_getaffinity', lambda pid: set(range(cores)))
+    def fake_open(path, *a, **k):
+        if path not in files: raise FileNotFoundError(path)
+        return io.StringIO(files[path])
+    monkeypatch.setattr(app, 'open', fake_open, raising=False)
+
+@pytest.mark.parametrize('files, cpus', [
+    ({}, 8),
+    ({'/sys/fs/cgroup/cpu.max': "max 100000\n"}, 8),
+    ({'/sys/fs/cgroup/cpu.max': "100000 100000\n"}, 1),
+    ({'/sys/fs/cgroup/cpu.max': "250000 100000\n"}, 2),
+    ({'/sys/fs/cgroup/cpu/cpu.cfs_quota_us': "50000\n", '/sys/fs/cgroup/cpu/cpu.cfs_period_us': "100000\n"}, 1),
+    ({'/sys/fs/cgroup/cpu/cpu.cfs_quota_us': "-1\n", '/sys/fs/cgroup/cpu/cpu.cfs_period_us': "100000\n"}, 8),
+])
+def test_cpu_quota_reads_cgroup(monkeypatch, files, cpus):
+    fake_files(monkeypatch, files)
+    assert app.cpu_quota() == cpus
+
+def test_pool_is_opt_in(monkeypatch):
+    fake_files(monkeypatch, {})
+    monkeypatch.delenv('DIEM_PARSE_WORKERS', raising=False)
+    assert app.parse_pool_workers() == 1
+    monkeypatch.setenv('DIEM_PARSE_WORKERS', '4')
+    assert app.parse_pool_workers() == 4
+    fake_files(monkeypatch, {'/sys/fs/cgroup/cpu.max': "100000 100000\n"})
+    assert app.parse_pool_workers() == 1
+
+def test_pool_matches_serial_and_is_shut_down(monkeypatch):
+    monkeypatch.setenv('DIEM_PARSE_WORKERS', '2')
+    monkeypatch.setattr(app, 'cpu_quota', lambda: 2)
+    made = []
+    class Pool(app.ProcessPoolExecutor):
+        def submit(self, *a, **k): made.append(self); return super().submit(*a, **k)
+    monkeypatch.setattr(app, 'ProcessPoolExecutor', Pool)
+    data = app._read_as(bench.make_workbook(6, 20, 3), 'xlsx')
+    serial = app.parse_score_sheets(data, "2025-2026", 'HK1', "Lớp 6", pool=False)
+    assert not made
+    assert app.parse_score_sheets(data, "2025-2026", 'HK1', "Lớp 6", pool=True) == serial
+    assert len(made) == 3 and not multiprocessing.active_children()
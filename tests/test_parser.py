@@ -0,0 +1,69 @@
+# parse_score_workbook (bản vector hóa) phải cho đúng kết quả như vòng lặp iterrows cũ trong upload_firebase.
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+def old_parse(data, year, sem, cls):
+    # Chép lại vòng lặp đọc sheet điểm của bản gốc (trước khi vector hóa), bỏ phần ghi Firestore
+    students, recs = {}, {}
+    for sname, df in data.items():
+        if any(x in str(sname).lower() for x in ["hướng dẫn", "bìa"]): continue
+        h_idx = -1
+        for i, row in df.iterrows():
+            if row.astype(str).str.contains("Mã học sinh", case=False).any(): h_idx = i; break
+        if h_idx == -1: continue
+        df.columns = df.iloc[h_idx]; df = df.iloc[h_idx+1:]
+        idx_ma = next((i for i, c in enumerate(df.columns.tolist()) if "Mã học sinh" in str(c)), -1)
+        if idx_ma == -1: continue
+        for _, row in df.iterrows():
+            ma = app.safe_str(row.iloc[idx_ma])
+            if len(ma) <= 3: continue
+            try: students[ma] = app.safe_str(row.iloc[idx_ma-2])
+            except Exception: pass
+            def g(o):
+                try: return app.safe_str(row.iloc[idx_ma+o])
+                except Exception: return ""
+            sub = str(sname).strip().replace("/", "-")
+            recs[f"{ma}_{year}_{sem}_{sub}"] = {
+                'id': ma, 'year': year, 'sem': sem, 'cls': cls, 'sub': sub,
+                'tx': "  ".join([g(k) for k in range(1, 10) if g(k)]),
+                'gk': g(16), 'ck': g(26), 'tb': g(27), 'cn': (g(28) if sem == 'HK2' else ""),
+            }
+    return students, recs
+
+def random_cell(rng):
+    r = rng.random()
+    if r < 0.25: return None
+    if r < 0.30: return np.nan
+    if r < 0.60: return round(rng.uniform(0, 10), rng.choice([0, 1, 2]))
+    if r < 0.70: return float(rng.randint(0, 10))
+    if r < 0.80: return rng.choice(["Đ", "CĐ", " 7.5 ", "8.0", "", "nan", "None"])
+    return rng.randint(0, 10)
+
+def random_sheet(rng):
+    width = rng.randint(5, 36)
+    idx_ma = rng.randint(0, min(5, width - 1))
+    rows = [[rng.choice([None, "SỞ GD&ĐT", "BẢNG ĐIỂM"]) for _ in range(width)] for _ in range(rng.randint(0, 4))]
+    head = [rng.choice([None, "STT", "Họ và tên", "TX"]) for _ in range(width)]
+    head[idx_ma] = rng.choice(["Mã học sinh", " Mã học sinh ", "Mã học sinh (*)"])
+    rows.append(head)
+    for i in range(rng.randint(0, 30)):
+        r = [random_cell(rng) for _ in range(width)]
+        r[idx_ma] = rng.choice([f"24{i:06d}", float(f"24{i:06d}"), int(f"24{i:06d}"), "12", None, f" 25{i:05d} "])
+        if idx_ma >= 2 or rng.random() < 0.5: r[idx_ma - 2] = rng.choice([f"Học sinh {i}", None, "  Lê  Văn A "])
+        rows.append(r)
+    return pd.DataFrame(rows)
+
+@pytest.mark.parametrize('seed', range(300))
+def test_matches_old_loop(seed):
+    rng = random.Random(seed)
+    data = {rng.choice(["Toán", "Ngữ văn", "GDQP/AN", "Tin học", "Bìa", "Hướng dẫn"]) + str(i): random_sheet(rng) for i in range(rng.randint(1, 3))}
+    sem = rng.choice(["HK1", "HK2"])
+    assert app.parse_score_workbook({k: v.copy() for k, v in data.items()}, "2025-2026", sem, "Lớp 6") == old_parse(data, "2025-2026", sem, "Lớp 6")
+
+def test_no_header():
+    assert app.parse_score_workbook({"Toán": pd.DataFrame([[1, 2], [3, 4]])}, "2025-2026", "HK1", "Lớp 6") == ({}, {})
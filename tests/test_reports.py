@@ -0,0 +1,67 @@
+# Phiếu điểm dựng sẵn (reports): gộp môn giữa các lần nạp, dựng từ dữ liệu cũ, 1 lần đọc cho màn hình HS
+import io
+import random
+
+import pandas as pd
+
+import app
+import bench
+
+Y, CLS, MA = app.YEAR_LIST[0], "Lớp 6", "240600000"
+
+def workbook(subs, seed=0):
+    rng = random.Random(seed); bio = io.BytesIO()
+    with pd.ExcelWriter(bio) as w:
+        for s in subs: bench.make_sheet(6, 3, rng).to_excel(w, sheet_name=s, index=False, header=False)
+    return bio.getvalue()
+
+def upload(db, raw, sem='HK1', type_file='score'): return app.upload_firebase(db, io.BytesIO(raw), Y, sem, CLS, type_file)
+
+def report_subs(db, sem='HK1'): return sorted(r['sub'] for r in app.load_student_result(db, MA, Y, sem)[0])
+
+def summary_csv(rows):
+    df = pd.DataFrame(rows, columns=['Mã học sinh', 'Loại TK', 'Học tập', 'Rèn luyện', 'Vắng', 'Danh hiệu', 'Kết quả'])
+    return df.to_csv(index=False).encode()
+
+def test_report_keeps_subjects_from_other_files(db):
+    upload(db, workbook(['Toán', 'Ngữ văn']))
+    upload(db, workbook(['Vật lí']))
+    assert report_subs(db) == sorted(['Toán', 'Ngữ văn', 'Vật lí'])
+    upload(db, workbook(['Toán'], seed=5))
+    rows = {r['sub']: r for r in app.load_student_result(db, MA, Y, 'HK1')[0]}
+    assert len(rows) == 3 and rows['Toán']['tx'] == db.data['scores'][f"{MA}_{Y}_HK1_Toán"]['tx']
+
+def test_report_seeded_from_legacy_data(db):
+    upload(db, workbook(['Toán', 'Ngữ văn']))
+    upload(db, summary_csv([[MA, 'HK1', 'Tốt', 'Tốt', '1', 'HS Xuất sắc', '']]), type_file='summary')
+    db.data['reports'].clear()  # dữ liệu nạp trước khi có phiếu dựng sẵn
+    upload(db, workbook(['Hóa học']))
+    assert report_subs(db) == sorted(['Toán', 'Ngữ văn', 'Hóa học'])
+    assert db.data['reports'][f"{MA}_{Y}_HK1"]['summary']['dh'] == 'HS Xuất sắc'
+
+def test_report_seeded_by_one_query_per_collection(db):
+    upload(db, bench.make_workbook(6, 40, 15, seed=1))
+    db.data['reports'].clear(); app.cache_clear(); db.stats.clear()
+    upload(db, bench.make_workbook(6, 40, 15, seed=1))
+    assert db.stats['queries'] == 2  # scores + summary của cả lớp, không phải 1 query / HS
+    assert len(db.data['reports']) == 40
+
+def test_summary_upload_keeps_score_rows(db):
+    upload(db, workbook(['Toán']), sem='HK2')
+    db.data['reports'].clear()
+    upload(db, summary_csv([[MA, 'HK2', 'Khá', 'Tốt', '0', '', ''], [MA, 'CN', 'Khá', 'Tốt', '2', '', 'Lên lớp']]), sem='HK2', type_file='summary')
+    rows, tk, cn = app.load_student_result(db, MA, Y, 'HK2')
+    assert [r['sub'] for r in rows] == ['Toán'] and tk['ht'] == 'Khá' and cn['kq'] == 'Lên lớp'
+
+def test_lookup_is_one_read(db):
+    for sem in ('HK1', 'HK2'): upload(db, workbook(['Toán', 'Ngữ văn']), sem=sem)
+    for sem in ('HK1', 'HK2'):
+        db.stats.clear()
+        rows, tk, cn = app.load_student_result(db, MA, Y, sem)
+        assert len(rows) == 2 and tk == {} and cn == {}
+        assert db.stats['reads'] == 1
+
+def test_delete_clears_report(db):
+    upload(db, workbook(['Toán']))
+    app.delete_data_year(db, 'scores', Y, CLS, 'HK1')
+    assert app.load_student_result(db, MA, Y, 'HK1')[0] == []
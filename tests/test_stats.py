@@ -0,0 +1,53 @@
+# Thống kê lớp/môn: cộng dồn bằng Increment phải khớp tính lại từ đầu, không cộng 2 lần khi ghi lỗi
+import io
+from collections import Counter
+
+from google.api_core import exceptions as gexc
+
+import app
+import bench
+
+Y, CLS = app.YEAR_LIST[0], "Lớp 6"
+DOC = f"{Y}_{CLS}_HK1_Toán"
+
+def agg(n): return {(CLS, 'HK1', 'Toán'): Counter({'n': n, 'tb|n': n, 'tb|sum': 7.0 * n})}
+
+def norm_stats(db):
+    return {k: {a: round(b, 6) for a, b in v['agg'].items() if abs(b) > 1e-9} for k, v in db.data['stats'].items() if v['agg'].get('n', 0) > 0}
+
+def test_incremental_stats_match_rebuild(db):
+    for c in (6, 7): app.upload_firebase(db, io.BytesIO(bench.make_workbook(c, 30, 4)), Y, 'HK2', f"Lớp {c}", 'score')
+    app.cache_clear()
+    app.upload_firebase(db, io.BytesIO(bench.make_workbook(6, 25, 4, seed=3)), Y, 'HK2', CLS, 'score')
+    inc = norm_stats(db)
+    app.rebuild_stats(db, Y, "Tất cả")
+    assert inc == norm_stats(db)
+
+def test_stats_increments_from_two_writers(db):
+    w1, w2 = app.ParallelWriter(db), app.ParallelWriter(db)
+    app.apply_stats(db, w1, Y, 'score', agg(3), {}); app.apply_stats(db, w2, Y, 'score', agg(4), {})
+    w1.close(); w2.close()
+    assert db.data['stats'][DOC]['agg'] == {'n': 7, 'tb|n': 7, 'tb|sum': 49.0}
+    with app.ParallelWriter(db) as w: app.apply_stats(db, w, Y, 'score', {}, agg(7))
+    assert db.data['stats'][DOC]['agg'] == {'n': 0, 'tb|n': 0, 'tb|sum': 0.0}
+
+def test_timeout_after_commit_is_not_applied_twice(flaky_db):
+    # Commit đã ghi nhưng client nhận DeadlineExceeded: không được gửi lại Increment
+    flaky_db.failures = [(gexc.DeadlineExceeded("timeout"), True)]
+    with app.ParallelWriter(flaky_db) as w: app.apply_stats(flaky_db, w, Y, 'score', agg(40), {})
+    assert flaky_db.data['stats'][DOC]['agg'] == {'n': 40, 'tb|n': 40, 'tb|sum': 280.0}
+    assert w.errors and w.errors[0][0] == f"stats/{DOC}"
+
+def test_rejected_commit_is_retried(flaky_db):
+    flaky_db.failures = [(gexc.Aborted("tranh chấp"), False), (gexc.ResourceExhausted("quota"), False)]
+    with app.ParallelWriter(flaky_db) as w: app.apply_stats(flaky_db, w, Y, 'score', agg(40), {})
+    assert flaky_db.data['stats'][DOC]['agg'] == {'n': 40, 'tb|n': 40, 'tb|sum': 280.0} and not w.errors
+
+def test_stats_go_in_their_own_batch(flaky_db):
+    # Lỗi không rõ kết quả ở batch thống kê không làm hỏng batch điểm (vẫn được thử lại bình thường)
+    with app.ParallelWriter(flaky_db, workers=1) as w:
+        w.set(flaky_db.collection('scores').document('a'), {'tb': '7'})
+        flaky_db.failures = [(gexc.DeadlineExceeded("timeout"), True), None, (gexc.DeadlineExceeded("timeout"), True)]
+        app.apply_stats(flaky_db, w, Y, 'score', agg(1), {})
+    assert flaky_db.data['scores']['a'] == {'tb': '7'}
+    assert flaky_db.data['stats'][DOC]['agg']['n'] == 1 and [p for p, _ in w.errors] == [f"stats/{DOC}"]
@@ -0,0 +1,30 @@
+# Cache file upload: dùng lại kết quả đọc theo nội dung file, giới hạn theo dung lượng, khóa theo tập parser
+import io
+
+import pandas as pd
+
+import app
+import bench
+
+def test_same_content_is_read_once(db, monkeypatch):
+    raw = bench.make_workbook(6, 5, 2); calls = []
+    read_as = app._read_as
+    monkeypatch.setattr(app, '_read_as', lambda r, p: calls.append(p) or read_as(r, p))
+    first = app.load_excel_robust(io.BytesIO(raw))
+    assert app.load_excel_robust(io.BytesIO(bytes(raw))) is first and calls == ['xlsx']
+
+def test_keyed_by_parsers(db):
+    csv = "Mã học sinh,Họ và tên\n1234,A\n".encode()
+    assert 'Mã học sinh' in list(app.load_table_robust(io.BytesIO(csv)).columns)
+    assert app.load_excel_robust(io.BytesIO(csv)) is None  # không dùng lại kết quả đọc CSV
+
+def test_evicts_by_bytes(db, monkeypatch):
+    monkeypatch.setattr(app, 'UPLOAD_CACHE_BYTES', 1000)
+    app.cache_put('a', b'x' * 600); app.cache_put('b', b'y' * 600)
+    c = app._upload_cache()
+    assert list(c['lru']) == ['b'] and c['bytes'] == 600
+    app.cache_put('lon', b'z' * 5000)  # lớn hơn cả giới hạn -> không cache
+    assert list(c['lru']) == ['b'] and app.cache_get('lon') is None
+
+def test_dataframe_size_counts_contents():
+    assert app.approx_size(pd.DataFrame({'a': ['x' * 100] * 100})) > 100 * 100
@@ -0,0 +1,34 @@
+# ParallelWriter: chia batch, thử lại lỗi tạm thời, báo lỗi từng document
+from google.api_core import exceptions as gexc
+
+import app
+
+def write_docs(db, n, **kw):
+    with app.ParallelWriter(db, **kw) as w:
+        for i in range(n): w.set(db.collection('c').document(f"d{i}"), {'i': i})
+    return w
+
+def test_splits_into_batches(db):
+    w = write_docs(db, 1000, batch_size=400)
+    assert w.written == 1000 and not w.errors and len(db.data['c']) == 1000
+
+def test_retries_transient_errors(flaky_db):
+    flaky_db.failures = [(gexc.ServiceUnavailable("x"), False), (gexc.Aborted("x"), False), (gexc.DeadlineExceeded("x"), False)]
+    w = write_docs(flaky_db, 10)
+    assert w.written == 10 and not w.errors and not flaky_db.failures
+
+def test_reports_permanent_error_per_document(flaky_db):
+    flaky_db.failures = [(gexc.PermissionDenied("cấm"), False)]
+    w = write_docs(flaky_db, 5)
+    assert w.written == 0 and not flaky_db.data['c']
+    assert sorted(p for p, _ in w.errors) == [f"c/d{i}" for i in range(5)] and 'cấm' in w.errors[0][1]
+
+def test_gives_up_after_retries(flaky_db):
+    flaky_db.failures = [(gexc.ServiceUnavailable("x"), False)] * 3
+    w = write_docs(flaky_db, 3, retries=2)
+    assert w.written == 0 and len(w.errors) == 3
+
+def test_failed_batch_does_not_block_others(flaky_db):
+    flaky_db.failures = [(gexc.PermissionDenied("x"), False)]
+    w = write_docs(flaky_db, 10, batch_size=5, workers=1)
+    assert w.written == 5 and len(w.errors) == 5 and len(flaky_db.data['c']) == 5